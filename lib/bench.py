@@ -0,0 +1,219 @@
+""" Offline embedder benchmark.
+
+    Fixtures are JSON lines of {"category", "name", "bits", "bil"}, where bil
+    is the repr of the lifted BIL (as read back by bap.bil.loads), so the
+    benchmark runs without bap-server or llvm-mc. bits is the encoding as
+    unseparated hex digits (e.g. "4883c408").
+
+    bench/x86_64.jsonl holds the default instruction mix (arithmetic, flags,
+    division, loads/stores, AVX and branches). Its BIL is synthetic: it was
+    written by hand after bap's lifter output (with temporaries named v1,
+    v2, ...) rather than recorded. It has the semantics of each entry's
+    bits, flags included, but its exact terms may differ from what bap
+    produces. Re-record it from bench/x86_64.insns with a real bap-server
+    before using its numbers as a baseline.
+
+    Recorded fixtures carry the version of the lifter that produced them.
+    Results say whether every fixture was recorded, and compare warns when
+    either side ran on fixtures that weren't.
+
+    Every instruction is replayed, visited and extracted rounds times and
+    the fastest time of each phase is kept. Results are summed per category
+    and written as JSON, so runs on different commits can be compared.
+
+    Usage:
+      python -m lib.bench record <insns.txt> <fixtures.jsonl>
+      python -m lib.bench run [--fixtures F] [-o out.json] [--lazy-memory]
+                              [--raw-terms]
+      python -m lib.bench compare <old.json> <new.json>
+
+    record reads lines of "<category> <hex bytes>" and needs bap-server.
+"""
+from argparse import ArgumentParser
+from binascii import hexlify
+from collections import OrderedDict
+from json import dumps, loads
+from subprocess import check_output
+from timeit import default_timer
+import os
+import sys
+
+from bap import disasm
+from bap.adt import visit
+from bap.bil import loads as loadBil
+from z3 import Context, get_version_string
+from .util import Bits, flatten
+from .z3_embed.embedder import toBinStr
+from .z3_embed.lift_cache import bapVersion
+from .z3_embed.x86_64_embedder import x86Class
+
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'bench', 'x86_64.jsonl')
+PHASES = ['replay', 'visit', 'extract']
+
+
+def record(src, dst, target='x86-64'):
+    """ Lift every "<category> <hex bytes>" line of src with bap and write
+        the fixtures to dst
+    """
+    lifter = bapVersion()
+    with open(src) as f, open(dst, 'w') as out:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            category, hexBits = line.split(None, 1)
+            bits = Bits(hexBits)
+            # disasm returns a generator, and both name and bil need it
+            insns = list(disasm(toBinStr(bits), arch=target))
+            out.write(dumps({
+                'category': category,
+                'name': '; '.join(i.asm.strip() for i in insns),
+                'bits': hexlify(toBinStr(bits)),
+                'bil': repr(flatten([i.bil for i in insns])),
+                'lifter': lifter},
+                sort_keys=True) + '\n')
+
+
+def loadFixtures(path):
+    with open(path) as f:
+        return [loads(line) for line in f if len(line.strip()) > 0]
+
+
+def termSize(asserts):
+    """ Number of distinct nodes in the DAG of asserts """
+    seen = set()
+    stack = list(asserts)
+    while len(stack) > 0:
+        t = stack.pop()
+        if t.get_id() in seen:
+            continue
+        seen.add(t.get_id())
+        stack.extend(t.children())
+    return len(seen)
+
+
+def benchOne(fixture, visitor_class, ctx, rounds):
+    """ Fastest time of each phase over rounds, plus the size of the
+        extracted formula
+    """
+    best = dict((p, float('inf')) for p in PHASES)
+    for _ in range(rounds):
+        t0 = default_timer()
+        bil = loadBil(fixture['bil'])
+        t1 = default_timer()
+        visitor = visitor_class(ctx)
+        visit(visitor, bil)
+        t2 = default_timer()
+        asserts = visitor.extract()
+        t3 = default_timer()
+        for (p, t) in zip(PHASES, [t1 - t0, t2 - t1, t3 - t2]):
+            best[p] = min(best[p], t)
+
+    best['asserts'] = len(asserts)
+    best['nodes'] = termSize(asserts)
+    return best
+
+
+def gitRevision():
+    try:
+        return check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stderr=open(os.devnull, 'w')).strip()
+    except Exception:
+        return None
+
+
+def run(fixtures, rounds=5, lazyMemory=False, rawTerms=False):
+    """ Benchmark every fixture. Returns a JSON-able dict with per
+        instruction results and per category totals.
+    """
+    visitor_class = x86Class(lazyMemory, rawTerms)
+    ctx = Context()
+    insns = []
+    totals = OrderedDict()
+    keys = PHASES + ['asserts', 'nodes']
+    for fx in fixtures:
+        res = benchOne(fx, visitor_class, ctx, rounds)
+        insns.append(OrderedDict([('category', fx['category']),
+                                  ('name', fx['name']),
+                                  ('bits', fx['bits'])] +
+                                 [(k, res[k]) for k in keys]))
+        for cat in (fx['category'], 'all'):
+            tot = totals.setdefault(cat, OrderedDict((k, 0) for k in keys))
+            for k in keys:
+                tot[k] += res[k]
+
+    if 'all' in totals:
+        totals['all'] = totals.pop('all')
+    return OrderedDict([
+        ('revision', gitRevision()),
+        ('python', sys.version.split()[0]),
+        ('z3', get_version_string()),
+        ('embedder', visitor_class.__name__),
+        ('recorded', all('lifter' in fx for fx in fixtures)),
+        ('lifters', sorted(set(fx['lifter'] for fx in fixtures
+                               if 'lifter' in fx))),
+        ('rounds', rounds),
+        ('categories', totals),
+        ('instructions', insns)])
+
+
+def compare(old, new):
+    """ Lines of new/old ratios of every phase and size per category """
+    keys = PHASES + ['asserts', 'nodes']
+    lines = ['warning: %s results ran on fixtures not recorded from bap'
+             % side for (side, res) in [('old', old), ('new', new)]
+             if not res.get('recorded', False)]
+    if old.get('lifters') != new.get('lifters'):
+        lines.append('warning: fixtures were lifted by different versions')
+    lines.append('%-10s' % 'category' + ''.join('%10s' % k for k in keys))
+    for (cat, newTot) in new['categories'].iteritems():
+        oldTot = old['categories'].get(cat)
+        if oldTot is None:
+            continue
+        lines.append('%-10s' % cat + ''.join(
+            '%10.2f' % (float(newTot[k]) / oldTot[k]) if oldTot[k] else
+            '%10s' % '-' for k in keys))
+    return lines
+
+
+def main():
+    p = ArgumentParser(description='Offline embedder benchmark')
+    sub = p.add_subparsers(dest='cmd')
+    rec = sub.add_parser('record', help='lift instructions into fixtures')
+    rec.add_argument('src')
+    rec.add_argument('dst')
+    rec.add_argument('--target', default='x86-64')
+    rn = sub.add_parser('run', help='benchmark the embedder on fixtures')
+    rn.add_argument('--fixtures', default=DEFAULT_FIXTURES)
+    rn.add_argument('--rounds', type=int, default=5)
+    rn.add_argument('--lazy-memory', action='store_true')
+    rn.add_argument('--raw-terms', action='store_true')
+    rn.add_argument('-o', '--output', default=None,
+                    help='write the JSON results here instead of stdout')
+    cm = sub.add_parser('compare', help='compare two benchmark results')
+    cm.add_argument('old')
+    cm.add_argument('new')
+    args = p.parse_args()
+
+    if args.cmd == 'record':
+        record(args.src, args.dst, args.target)
+    elif args.cmd == 'run':
+        res = dumps(run(loadFixtures(args.fixtures), args.rounds,
+                        args.lazy_memory, args.raw_terms), indent=2)
+        if args.output is None:
+            print res
+        else:
+            with open(args.output, 'w') as f:
+                f.write(res + '\n')
+    else:
+        with open(args.old) as f:
+            old = loads(f.read(), object_pairs_hook=OrderedDict)
+        with open(args.new) as f:
+            new = loads(f.read(), object_pairs_hook=OrderedDict)
+        print '\n'.join(compare(old, new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+""" Embed a whole corpus of instructions (one hex encoding per line, as in
+    libxul.hex) over a process pool.
+
+    Results and failures are written as JSON lines into numbered shard files
+    in the output directory. Each shard is written to a temporary file and
+    renamed into place once complete, after which the checkpoint file is
+    updated to point past it. A killed run therefore resumes at the first
+    line not covered by a complete shard, redoing at most one shard.
+
+    Each worker process lifts through a bap-server of its own, spawned on a
+    free port when the worker starts and stopped with it.
+
+    Usage: python -m lib.corpus <corpus.hex> <output-dir> [-j N]
+"""
+from argparse import ArgumentParser
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from multiprocessing.util import Finalize
+from signal import signal, SIGTERM
+from traceback import format_exc
+from json import dumps, loads
+import os
+
+from bap.rpc import get_instance, del_instance
+from .util import Bits, freePort
+from .z3_embed import bitsToBil, LiftCache, ContextPool, TemplateCache, \
+    FormulaStore, toSmt2
+from .z3_embed.x86_64_embedder import x86Class
+from .z3_embed.profile import Profiler
+
+CHECKPOINT = 'checkpoint.json'
+
+# Per worker process state, set up by _initWorker.
+_worker = {}
+
+
+def _stopWorker(signum, frame):
+    del_instance()  # Terminates the worker's bap-server
+    os._exit(0)
+
+
+def _initWorker(cacheDir, templates, smt2, lazyMemory, rawTerms, profile):
+    # Every worker lifts through its own bap-server, so lifting scales with
+    # the number of workers rather than queueing on a single server. Worker
+    # processes don't run atexit handlers, so the server is stopped by a
+    # finalizer when the worker exits, or from the handler of the SIGTERM
+    # Pool.terminate sends to busy workers.
+    get_instance(server={'port': freePort()})
+    Finalize(None, del_instance, exitpriority=0)
+    signal(SIGTERM, _stopWorker)
+
+    _worker['smt2'] = smt2
+    prof = Profiler() if profile else None
+    _worker['prof'] = prof
+    cls = x86Class(lazyMemory, rawTerms)
+    if prof is not None:
+        cls = prof.embedderClass(cls)
+
+    if templates:
+        embed = TemplateCache(cls).embed
+    else:
+        embed = partial(ContextPool().embed, visitor_class=cls)
+    if prof is not None:
+        _worker['embed'] = partial(prof.phase, 'embed', embed)
+        _worker['lift'] = prof.bitsToBil
+    else:
+        _worker['embed'] = embed
+        _worker['lift'] = bitsToBil
+    _worker['cache'] = LiftCache(cacheDir) if cacheDir else None
+
+
+def _result(*res):
+    """ Append the worker's profile since its last result (if profiling) """
+    prof = _worker['prof']
+    return res + (prof.take() if prof is not None else None,)
+
+
+def _embedLine(arg):
+    lineNo, line = arg
+    try:
+        b = Bits(line)
+        bil = _worker['lift'](b, cache=_worker['cache'])
+    except Exception:
+        return _result(lineNo, line, 'parse', format_exc(), None)
+    try:
+        asserts = _worker['embed'](bil)
+    except Exception:
+        return _result(lineNo, line, 'embed', format_exc(), None)
+    return _result(lineNo, line, None, [a.sexpr() for a in asserts],
+                   toSmt2(asserts) if _worker['smt2'] else None)
+
+
+def _atomicWrite(path, data):
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmpPath, path)
+
+
+def loadCheckpoint(outDir):
+    try:
+        with open(os.path.join(outDir, CHECKPOINT)) as f:
+            return loads(f.read())
+    except IOError:
+        return {'line': 0, 'shard': 0}
+
+
+def _writeShard(outDir, ckpt, results, failures, nextLine):
+    shard = ckpt['shard']
+    _atomicWrite(os.path.join(outDir, 'results.%05d.jsonl' % shard),
+                 ''.join(dumps(r) + '\n' for r in results))
+    _atomicWrite(os.path.join(outDir, 'failures.%05d.jsonl' % shard),
+                 ''.join(dumps(r) + '\n' for r in failures))
+    ckpt = {'line': nextLine, 'shard': shard + 1}
+    _atomicWrite(os.path.join(outDir, CHECKPOINT), dumps(ckpt))
+    return ckpt
+
+
+def run(corpus, outDir, jobs=None, shardSize=10000, cacheDir=None,
+        chunkSize=64, templates=False, storePath=None, lazyMemory=False,
+        rawTerms=False, profilePath=None):
+    """ Embed every line of corpus, resuming from outDir's checkpoint.
+        With templates, each worker embeds through a TemplateCache, so
+        instructions differing only in immediates are embedded once.
+        With storePath, the assertions of every instruction are also added
+        to the FormulaStore there, keyed by the instruction's bytes.
+        lazyMemory selects the lazy memory model (see BaseEmbedder), and
+        rawTerms the z3 C API term construction (see RawTermsEmbedder).
+        With profilePath, the workers are instrumented (see Profiler) and
+        their combined stats are dumped there as JSON.
+        Returns the final checkpoint.
+    """
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    ckpt = loadCheckpoint(outDir)
+
+    store = FormulaStore(storePath) if storePath else None
+    prof = Profiler() if profilePath else None
+    pool = Pool(jobs or cpu_count(), _initWorker,
+                (cacheDir, templates, store is not None, lazyMemory,
+                 rawTerms, prof is not None))
+    try:
+        with open(corpus) as f:
+            lines = ((i, l.strip())
+                     for (i, l) in enumerate(islice(f, ckpt['line'], None),
+                                             ckpt['line'])
+                     if len(l.strip()) > 0)
+            results = []
+            failures = []
+            count = 0
+            lastLine = ckpt['line'] - 1
+            for (lineNo, line, stage, payload, smt2, stats) in \
+                    pool.imap(_embedLine, lines, chunkSize):
+                if prof is not None:
+                    prof.merge(stats)
+                if stage is None:
+                    results.append({'line': lineNo, 'bits': line,
+                                    'asserts': payload})
+                    if store is not None:
+                        store.putSmt2(Bits(line).toBinStr(), smt2)
+                else:
+                    failures.append({'line': lineNo, 'bits': line,
+                                     'stage': stage, 'error': payload})
+                lastLine = lineNo
+                count += 1
+                if count == shardSize:
+                    if store is not None:
+                        store.flush()
+                    ckpt = _writeShard(outDir, ckpt, results, failures,
+                                       lastLine + 1)
+                    results, failures, count = [], [], 0
+
+            if count > 0:
+                if store is not None:
+                    store.flush()
+                ckpt = _writeShard(outDir, ckpt, results, failures,
+                                   lastLine + 1)
+    finally:
+        pool.terminate()
+        pool.join()
+        if store is not None:
+            store.close()
+        if prof is not None:
+            prof.dump(profilePath)
+    return ckpt
+
+
+def main():
+    p = ArgumentParser(description='Embed a corpus of x86-64 instructions')
+    p.add_argument('corpus', help='file with one hex encoding per line')
+    p.add_argument('outDir', help='directory for shards and the checkpoint')
+    p.add_argument('-j', '--jobs', type=int, default=None,
+                   help='number of worker processes (default: #cores)')
+    p.add_argument('--shard-size', type=int, default=10000)
+    p.add_argument('--lift-cache', default=None,
+                   help='directory of a LiftCache to share between workers')
+    p.add_argument('--templates', action='store_true',
+                   help='reuse the embedding of instructions that only '
+                        'differ in immediates')
+    p.add_argument('--store', default=None,
+                   help='path of a FormulaStore to add all results to')
+    p.add_argument('--lazy-memory', action='store_true',
+                   help='embed stores as lambdas and forward stored values '
+                        'to loads')
+    p.add_argument('--raw-terms', action='store_true',
+                   help='build terms through the z3 C API rather than z3py')
+    p.add_argument('--profile', default=None,
+                   help='instrument the embedder and dump its stats as JSON '
+                        'to this path')
+    args = p.parse_args()
+    ckpt = run(args.corpus, args.outDir, args.jobs, args.shard_size,
+               args.lift_cache, templates=args.templates,
+               storePath=args.store, lazyMemory=args.lazy_memory,
+               rawTerms=args.raw_terms, profilePath=args.profile)
+    print "Done. Processed up to line", ckpt['line'], "in", \
+        ckpt['shard'], "shards"
+
+
+if __name__ == '__main__':
+    main()
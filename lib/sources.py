@@ -0,0 +1,133 @@
+""" Streaming instruction sources.
+
+    sweep() memory-maps an ELF file (or a raw blob of code) and walks its
+    executable sections in linear-sweep order, yielding every instruction as
+    a zero-copy slice of the mapping. The slices can be handed straight to
+    bitsToBil/bitsToBilMany, so no intermediate hex corpus is needed, and
+    memory use stays bounded by the sweep window regardless of file size.
+"""
+from mmap import mmap, ACCESS_READ
+from struct import unpack_from, calcsize
+from bap import disasm
+from .z3_embed.embedder import MAX_BATCH_BYTES
+
+ELF_MAGIC = '\x7fELF'
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+SHT_NOBITS = 8
+SHF_EXECINSTR = 0x4
+
+# (e_shoff, e_shentsize, e_shnum, e_shstrndx) offsets/formats per ELF class
+_ehdrFmt = {
+    ELFCLASS32: ('I', 0x20, 0x2E),
+    ELFCLASS64: ('Q', 0x28, 0x3A),
+}
+# name, type, flags, addr, offset, size
+_shdrFmt = {
+    ELFCLASS32: 'IIIIII',
+    ELFCLASS64: 'IIQQQQ',
+}
+
+
+def isElf(buf):
+    return buf[:4] == ELF_MAGIC
+
+
+def elfSections(buf):
+    """ Parse the section headers of an ELF image.
+        Returns a list of (name, type, flags, addr, offset, size)
+    """
+    elfClass = ord(buf[4])
+    endian = '<' if ord(buf[5]) == ELFDATA2LSB else '>'
+    if elfClass not in _ehdrFmt:
+        raise Exception('Unknown ELF class ' + str(elfClass))
+
+    offFmt, shoffAt, shentAt = _ehdrFmt[elfClass]
+    shoff, = unpack_from(endian + offFmt, buf, shoffAt)
+    shentsize, shnum, shstrndx = unpack_from(endian + 'HHH', buf, shentAt)
+    shdrFmt = endian + _shdrFmt[elfClass]
+    assert shentsize >= calcsize(shdrFmt)
+
+    hdrs = [unpack_from(shdrFmt, buf, shoff + i * shentsize)
+            for i in range(shnum)]
+    if len(hdrs) == 0:
+        return []
+
+    strOff = hdrs[shstrndx][4]
+
+    def name(idx):
+        end = buf.find('\0', strOff + idx)
+        return buf[strOff + idx:end]
+
+    return [(name(h[0]),) + h[1:] for h in hdrs]
+
+
+def codeRegions(buf):
+    """ Return (name, addr, offset, size) for each executable region of buf.
+        Anything that isn't an ELF file is treated as one raw blob of code
+        loaded at address 0.
+    """
+    if not isElf(buf):
+        return [('<raw>', 0, 0, len(buf))]
+
+    return [(name, addr, off, size)
+            for (name, typ, flags, addr, off, size) in elfSections(buf)
+            if flags & SHF_EXECINSTR and typ != SHT_NOBITS and size > 0]
+
+
+def sweepRegion(buf, addr, off, size, target='x86-64',
+                window=MAX_BATCH_BYTES):
+    """ Linear sweep over buf[off:off+size] (mapped at addr) with bap's
+        disassembler, window bytes at a time. Yields (addr, slice) per
+        instruction. Bytes that don't decode are skipped: up to the next
+        instruction bap found in the window, or the whole window if it
+        found none (or failed on it).
+    """
+    pos = 0
+    while pos < size:
+        n = min(window, size - pos)
+        chunk = buffer(buf, off + pos, n)
+        base = addr + pos
+        insns = disasm(str(chunk), arch=target, addr=base)
+        if insns is None:
+            pos += n  # bap-server reported an error on this window
+            continue
+
+        consumed = 0
+        skipTo = pos + n
+        for insn in insns:
+            # Stop at the first gap or at an instruction cut off by the
+            # window. The next window will start there.
+            if insn.addr != base + consumed:
+                if consumed == 0:
+                    skipTo = insn.addr - addr
+                break
+            if (consumed + insn.size > n) or \
+               (consumed + insn.size == n and pos + n < size and
+                    consumed > 0):
+                if consumed == 0:
+                    skipTo = pos + 1
+                break
+            yield (insn.addr, buffer(buf, off + pos + consumed, insn.size))
+            consumed += insn.size
+
+        pos = pos + consumed if consumed > 0 else max(skipTo, pos + 1)
+
+
+def sweep(path, target='x86-64', window=MAX_BATCH_BYTES):
+    """ Memory-map path and yield (addr, slice) for every instruction in its
+        executable sections. Slices are buffer objects into the mapping and
+        are only valid while the generator is alive.
+
+        Note that each window is lifted by bap to find the boundaries, so
+        combine this with a LiftCache when lifting the results again.
+    """
+    with open(path, 'rb') as f:
+        mm = mmap(f.fileno(), 0, access=ACCESS_READ)
+    try:
+        for (_, addr, off, size) in codeRegions(mm):
+            for r in sweepRegion(mm, addr, off, size, target, window):
+                yield r
+    finally:
+        mm.close()
@@ -1,64 +1,105 @@
 from subprocess import Popen, PIPE
-from itertools import chain, izip_longest
+from itertools import chain, islice
+from collections import deque
+from tempfile import TemporaryFile
+from re import compile
+from binascii import hexlify, unhexlify
+from array import array
+from socket import socket
 
 
-def drain(iterable):
-    res = []
-    try:
-        while True:
-            res.append(iterable.next())
-    except StopIteration:
-        return res
-
-
-def grouper(iterable, n, fillvalue=None):
-    "Collect data into fixed-length chunks or blocks"
-    # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx
-    args = [iter(iterable)] * n
-    return izip_longest(fillvalue=fillvalue, *args)
+def parseHex(s):
+    """ Parse a string of whitespace separated hex bytes into raw bytes.
+        Tokens may carry a 0x prefix and may hold several bytes
+        ('4883c408'). An odd trailing digit is taken as the low nibble of
+        the last byte ('f' -> 0f, 'abc' -> ab 0c).
+    """
+    toks = s.split()
+    for (i, t) in enumerate(toks):
+        if t[:2] in ('0x', '0X'):
+            t = t[2:]
+        if len(t) % 2 == 1:
+            t = t[:-1] + '0' + t[-1]
+        toks[i] = t
+    return unhexlify(''.join(toks))
 
 
-class Bits:
+class Bits(object):
+    """ An instruction encoding. The bytes are held in a str, or in a
+        zero-copy buffer/memoryview into a larger blob (e.g. a HexCorpus);
+        the hex forms are only rendered on demand.
+    """
     def __init__(self, arg):
         if type(arg) == str:
-            hexL = [x.strip() for x in arg.split(' ')]
-            hexL = [x for x in hexL if len(x) > 0]
-            newHexL = []
-            for x in hexL:
-                if (len(x) == 1):
-                    newHexL.append('0' + x)
-                if (len(x) == 2):
-                    newHexL.append(x)
-                else:
-                    splitL = map(lambda x:  x[0] + x[1], drain(grouper(x, 2, '')))
-                    if len(splitL[-1]) == 1:
-                        splitL[-1] = '0' + splitL[-1]
-                    newHexL.extend(splitL)
-
-            self.mHexL = \
-                map(lambda x: '0x' + x if not x.startswith('0x') else x,
-                    newHexL)
+            self.mBytes = parseHex(arg)
         elif type(arg) == list:
-            hexL = [x.strip() for x in arg]
-            self.mHexL = \
-                map(lambda x: '0x' + x if not x.startswith('0x') else x,
-                    hexL)
+            self.mBytes = parseHex(' '.join(arg))
         else:
             raise Exception('Unkown bits type ' + str(arg))
 
+    @staticmethod
+    def fromBytes(raw):
+        """ Wrap raw bytes (str, buffer or memoryview) without copying """
+        if not isinstance(raw, (str, buffer, memoryview)):
+            raise Exception('Unkown bits type ' + str(raw))
+        b = Bits.__new__(Bits)
+        b.mBytes = raw
+        return b
+
+    def __len__(self):
+        return len(self.mBytes)
+
     def toHexList(self):
-        return self.mHexL
+        return ['0x' + hexlify(c) for c in self.toBinStr()]
 
     def toHexStr(self):
-        return ' '.join(self.mHexL)
+        return ' '.join(self.toHexList())
 
     def toBinStr(self):
-        return ''.join([chr(int(x, 16)) for x in self.mHexL])
+        if isinstance(self.mBytes, memoryview):
+            return self.mBytes.tobytes()
+        return str(self.mBytes)
+
 
+class HexCorpus(object):
+    """ A whole corpus file of hex encodings (one instruction per line)
+        parsed into a single buffer plus an offset index. corpus[i] is the
+        Bits for line i; it shares the corpus buffer rather than copying it.
+        Blank lines are kept as empty entries so indices match line numbers.
+    """
+    def __init__(self, path):
+        chunks = []
+        offsets = array('L', [0])
+        total = 0
+        with open(path) as f:
+            for l in f:
+                b = parseHex(l)
+                chunks.append(b)
+                total += len(b)
+                offsets.append(total)
+        self.mBuf = ''.join(chunks)
+        self.mOffsets = offsets
 
-def toAsm(bits):
-    p = Popen(['llvm-mc', '--disassemble'], stdin=PIPE, stdout=PIPE,
-              stderr=PIPE)
+    def __len__(self):
+        return len(self.mOffsets) - 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(idx)
+        start = self.mOffsets[idx]
+        return Bits.fromBytes(buffer(self.mBuf, start,
+                                     self.mOffsets[idx + 1] - start))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+def toAsm(bits, args=()):
+    p = Popen(['llvm-mc', '--disassemble'] + list(args), stdin=PIPE,
+              stdout=PIPE, stderr=PIPE)
     (stdout, stderr) = p.communicate(bits.toHexStr())
     if (stderr != '' or p.returncode != 0):
         raise Exception("llvm-mc failed disassembling string " +
@@ -66,5 +107,111 @@ def toAsm(bits):
     return stdout
 
 
+encodingRE = compile(r"#\s*encoding:\s*\[([^\]]*)\]")
+
+
+def _spawnAsm(batch, args):
+    # Feed stdin from a file, so that several workers can run concurrently
+    # without us having to juggle their pipes.
+    inp = TemporaryFile()
+    inp.write('\n'.join(b.toHexStr() for b in batch))
+    inp.write('\n')
+    inp.seek(0)
+    p = Popen(['llvm-mc', '--disassemble', '--show-encoding'] + list(args),
+              stdin=inp, stdout=PIPE, stderr=PIPE)
+    inp.close()
+    return p
+
+
+def _splitAsm(batch, stdout):
+    """ Split llvm-mc output back into per-instruction chunks, using the
+        encodings it prints to find the boundaries. Returns None if the
+        output doesn't line up with the input.
+    """
+    res = []
+    it = iter(batch)
+    cur = next(it, None)
+    lines = []
+    consumed = 0
+    for l in stdout.splitlines():
+        m = encodingRE.search(l)
+        if m is None:
+            continue  # Directives, e.g. .text
+        if cur is None:
+            return None
+        lines.append(l[:m.start()].strip())
+        consumed += len(m.group(1).split(','))
+        if consumed == len(cur):
+            res.append('\n'.join(lines))
+            lines = []
+            consumed = 0
+            cur = next(it, None)
+        elif consumed > len(cur):
+            return None
+    if cur is not None or len(lines) != 0:
+        return None
+    return res
+
+
+def toAsmMany(bitsIter, batchSize=1024, workers=4, args=()):
+    """ Disassemble many Bits with llvm-mc. llvm-mc only starts decoding at
+        EOF, so rather than one long-lived process, each batch of batchSize
+        instructions goes to its own llvm-mc process, with up to workers
+        processes running at once. A worker that dies or whose output can't
+        be split back per instruction just gets its batch redone with toAsm
+        one instruction at a time.
+
+        Yields (bits, asm, err) in input order, where asm is the instruction
+        text without directives or encodings and exactly one of asm/err is
+        None.
+    """
+    def collect(batch, p):
+        (stdout, stderr) = p.communicate()
+        split = None
+        if stderr == '' and p.returncode == 0:
+            split = _splitAsm(batch, stdout)
+
+        if split is not None:
+            for (bits, asm) in zip(batch, split):
+                yield (bits, asm, None)
+            return
+
+        for bits in batch:
+            try:
+                stdout = toAsm(bits, args)
+            except Exception, e:
+                yield (bits, None, e)
+                continue
+            lines = [encodingRE.sub('', l).strip()
+                     for l in stdout.splitlines()
+                     if not l.strip().startswith('.')]
+            yield (bits, '\n'.join(lines), None)
+
+    it = iter(bitsIter)
+    inFlight = deque()
+    while True:
+        batch = list(islice(it, batchSize))
+        if len(batch) != 0:
+            inFlight.append((batch, _spawnAsm(batch, args)))
+        if len(inFlight) == 0:
+            return
+        if len(batch) == 0 or len(inFlight) >= workers:
+            batch, p = inFlight.popleft()
+            for r in collect(batch, p):
+                yield r
+
+
 def flatten(listOfLists):
         return list(chain.from_iterable(listOfLists))
+
+
+def freePort():
+    """ A TCP port on localhost that was free a moment ago (e.g. for a
+        bap-server of one's own)
+    """
+    s = socket()
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
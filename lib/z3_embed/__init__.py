@@ -1,4 +1,20 @@
-from embedder import bitsToBil
-from x86_64_embedder import X86_64Z3Embedder, embed_x86
+from embedder import bitsToBil, bitsToBilMany, bitsToBils
+from lift_cache import LiftCache
+from x86_64_embedder import X86_64Z3Embedder, LazyX86_64Z3Embedder, \
+    RawX86_64Z3Embedder, RawLazyX86_64Z3Embedder, embed_x86, transfer_x86, \
+    embed_x86_block, transfer_x86_block
+from transfer import transferFunction, applyTactic
+from context_pool import ContextPool, PooledContext
+from thread_pool import EmbedThreadPool
+from async_embedder import AsyncEmbedder, RequestTimeout, RequestCancelled
+from template_cache import TemplateCache
+from formula_store import FormulaStore, toSmt2, fromSmt2
 
-__all__ = ["bitsToBil", "X86_64Z3Embedder", "embed_x86"]
+__all__ = ["bitsToBil", "bitsToBilMany", "bitsToBils", "LiftCache",
+           "X86_64Z3Embedder", "LazyX86_64Z3Embedder",
+           "RawX86_64Z3Embedder", "RawLazyX86_64Z3Embedder", "embed_x86",
+           "transfer_x86", "embed_x86_block", "transfer_x86_block",
+           "transferFunction", "applyTactic", "ContextPool", "PooledContext",
+           "EmbedThreadPool", "AsyncEmbedder", "RequestTimeout",
+           "RequestCancelled", "TemplateCache", "FormulaStore", "toSmt2",
+           "fromSmt2"]
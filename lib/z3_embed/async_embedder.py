@@ -0,0 +1,222 @@
+from multiprocessing.pool import ThreadPool
+from threading import Condition, Event, Lock, Thread
+from heapq import heappush, heappop
+from itertools import count
+from time import time
+from bap.rpc import get_instance
+from ..util import freePort
+from .embedder import bitsToBil
+from .formula_store import toSmt2
+from .thread_pool import EmbedThreadPool
+
+
+class RequestTimeout(Exception):
+    pass
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+class Request(object):
+    """ Pending result of an AsyncEmbedder request. Completes exactly once,
+        with a result or an error: whichever of the worker, cancel() or the
+        request's timeout gets there first wins, and the others are ignored.
+    """
+    def __init__(self):
+        self.mLock = Lock()
+        self.mDone = Event()
+        self.mResult = None
+        self.mError = None
+        self.mCallbacks = []
+
+    def finish(self, result=None, error=None):
+        """ Complete the request. Returns False if it already was """
+        with self.mLock:
+            if self.mDone.is_set():
+                return False
+            self.mResult = result
+            self.mError = error
+            self.mDone.set()
+            callbacks = self.mCallbacks
+            self.mCallbacks = []
+        for fn in callbacks:
+            fn(self)
+        return True
+
+    def cancel(self):
+        return self.finish(error=RequestCancelled())
+
+    def cancelled(self):
+        return isinstance(self.mError, RequestCancelled)
+
+    def done(self):
+        return self.mDone.is_set()
+
+    def result(self, timeout=None):
+        """ Wait (up to timeout seconds) for the result. Raises the
+            request's error if it failed.
+        """
+        if not self.mDone.wait(timeout):
+            raise RequestTimeout("Request not done after %s s" % timeout)
+        if self.mError is not None:
+            raise self.mError
+        return self.mResult
+
+    def addCallback(self, fn):
+        """ Call fn(request) once it is done (right away if it already is),
+            on whichever thread completes it. An event loop would schedule
+            its own continuation from here (e.g. with a thread-safe wakeup).
+        """
+        with self.mLock:
+            if not self.mDone.is_set():
+                self.mCallbacks.append(fn)
+                return
+        fn(self)
+
+
+class Deadlines(object):
+    """ Fails requests with RequestTimeout once their deadline passes. One
+        thread serves every request, waiting on a heap of deadlines, however
+        many requests are pending. A request that completes in time stays
+        on the heap until its deadline, where finishing it is a no-op.
+    """
+    def __init__(self):
+        self.mCond = Condition()
+        self.mHeap = []
+        self.mSeq = count()  # Keeps equal deadlines in insertion order
+        self.mClosed = False
+        self.mThread = Thread(target=self._run)
+        self.mThread.daemon = True
+        self.mThread.start()
+
+    def add(self, req, timeout):
+        with self.mCond:
+            heappush(self.mHeap,
+                     (time() + timeout, next(self.mSeq), req, timeout))
+            self.mCond.notify()
+
+    def _run(self):
+        while True:
+            with self.mCond:
+                while not self.mClosed and \
+                        (len(self.mHeap) == 0 or self.mHeap[0][0] > time()):
+                    self.mCond.wait(self.mHeap[0][0] - time()
+                                    if len(self.mHeap) > 0 else None)
+                if self.mClosed:
+                    return
+                _, _, req, timeout = heappop(self.mHeap)
+            # Outside the lock, as finishing runs the request's callbacks
+            req.finish(error=RequestTimeout(
+                "Request timed out after %s s" % timeout))
+
+    def close(self):
+        with self.mCond:
+            self.mClosed = True
+            self.mCond.notify()
+        self.mThread.join()
+
+
+class AsyncEmbedder(object):
+    """ Non-blocking front end for lifting and embedding instructions, for
+        callers that mustn't block on bap-server (e.g. an event loop).
+
+        Every call returns a Request right away. Lifts run on connections
+        threads, each with a bap-server of its own (spawned on a free port
+        when the thread starts, as corpus workers do, and stopped by
+        close()), which bounds the number of requests in flight to bap.
+        Embedding runs on a separate EmbedThreadPool, so a slow or hung lift
+        only holds up its own server, never the other lift threads or the
+        embedding of requests that were already lifted. Further requests
+        queue up.
+
+        A request with a timeout fails with RequestTimeout once it expires,
+        and cancel() fails it with RequestCancelled. Work that hasn't started
+        by then is skipped. A lift already waiting on bap-server can't be
+        interrupted though, and keeps its connection busy until it returns.
+    """
+    def __init__(self, visitor_class, connections=4, threads=None,
+                 target='x86-64', cache=None):
+        self.mClass = visitor_class
+        self.mTarget = target
+        self.mCache = cache
+        self.mServers = []
+        self.mServersLock = Lock()
+        self.mDeadlines = Deadlines()
+        self.mLiftPool = ThreadPool(connections, self._initLift)
+        self.mEmbedPool = EmbedThreadPool(visitor_class, threads)
+
+    def _initLift(self):
+        # bap.rpc keeps its instance per thread, so this thread's lifts all
+        # go to the server spawned here
+        bap = get_instance(server={'port': freePort()})
+        with self.mServersLock:
+            self.mServers.append(bap)
+
+    def _request(self, timeout):
+        req = Request()
+        if timeout is not None:
+            self.mDeadlines.add(req, timeout)
+        return req
+
+    def _lift(self, req, bits, then):
+        if req.done():
+            return
+        try:
+            bil = bitsToBil(bits, self.mTarget, self.mCache)
+        except Exception, e:
+            req.finish(error=e)
+            return
+        then(req, bil)
+
+    def _embed(self, req, bil, outputs, fn):
+        if req.done():
+            return
+        try:
+            res = fn(self.mEmbedPool.contextPool().embed(bil, self.mClass,
+                                                         outputs))
+        except Exception, e:
+            req.finish(error=e)
+            return
+        req.finish(res)
+
+    def bitsToBil(self, bits, timeout=None):
+        """ Request the BIL of bits """
+        req = self._request(timeout)
+        self.mLiftPool.apply_async(
+            self._lift, (req, bits, lambda req, bil: req.finish(bil)))
+        return req
+
+    def embedBil(self, bil, outputs=None, fn=toSmt2, timeout=None):
+        """ Request fn(assertions) of bil (see EmbedThreadPool.map) """
+        req = self._request(timeout)
+        self.mEmbedPool.submit(self._embed, req, bil, outputs, fn)
+        return req
+
+    def embed(self, bits, outputs=None, fn=toSmt2, timeout=None):
+        """ Request fn(assertions) of bits. timeout covers lifting and
+            embedding together.
+        """
+        def then(req, bil):
+            self.mEmbedPool.submit(self._embed, req, bil, outputs, fn)
+
+        req = self._request(timeout)
+        self.mLiftPool.apply_async(self._lift, (req, bits, then))
+        return req
+
+    def close(self):
+        """ Wait for all queued requests and shut down the workers """
+        self.mLiftPool.close()
+        self.mLiftPool.join()
+        self.mEmbedPool.close()
+        self.mDeadlines.close()
+        with self.mServersLock:
+            for bap in self.mServers:
+                bap.close()  # Terminates the thread's bap-server
+            self.mServers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
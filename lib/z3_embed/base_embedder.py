@@ -1,7 +1,8 @@
-from bap.bil import Exp, LittleEndian, Stmt
+from bap.bil import Exp, LittleEndian, Stmt, Int, Var, Imm
 from z3 import BitVecVal, BitVecSort, ArraySort, eq, \
     Select, Concat, Const, Extract, ULE, ULT, LShR, Update, \
-    ZeroExt, If, SignExt, UDiv, URem, Not
+    ZeroExt, If, SignExt, UDiv, URem, Not, Lambda, is_bv_value, is_app_of, \
+    Z3_OP_BADD, Z3_OP_BSUB
 from .null_embedder import NullZ3Embedder
 from .embedder import boolToBV, bvToBool
 
@@ -12,7 +13,67 @@ class BaseEmbedder(NullZ3Embedder):
         Architecture specific embedders can overload methods for
         architecture specific behavior. (e.g. leave_Jump needs to talk
         about the specific RIP register)
+
+        z3 terms are hash-consed: every handler looks up its operator and
+        the AST ids of its operands in mTermCache before building anything,
+        so repeated subexpressions (e.g. the operands of the flag
+        computations after an add) reuse the term built the first time.
+        The cached terms keep their operands alive, so their ids can't be
+        recycled while the cache holds them.
+
+        Memory is a byte array. By default a load is a Concat of per-byte
+        Selects and a store a chain of per-byte Updates. Subclasses setting
+        lazyMemory instead embed a store as a single lambda term, however
+        wide, and remember it in mStores. A load then walks back over the
+        stores to the memory it reads from: it returns the stored value
+        (or a slice of it) when the offsets show it reads within one store,
+        and skips stores that provably don't overlap it. Only loads that may
+        alias a store are lowered to Selects.
+
+        Int and Var operands are built in place rather than through their
+        handlers. Subclasses that give Ints or Vars other semantics (e.g.
+        TemplateCache) clear inlineInts or inlineVars; wrapping the handlers
+        without changing what they build (e.g. Profiler) needn't.
     """
+    lazyMemory = False
+    inlineInts = True
+    inlineVars = True
+
+    def __init__(self, ctx, archTables=None, firstId=0):
+        NullZ3Embedder.__init__(self, ctx, archTables, firstId)
+        self.mTermCache = {}
+        self.mStores = {}
+        self.mFastInt = self.inlineInts
+        self.mFastVar = self.inlineVars
+
+    def release(self):
+        NullZ3Embedder.release(self)
+        self.mTermCache = {}
+        self.mStores = {}
+
+    def cached(self, key, mk, *args):
+        t = self.mTermCache.get(key)
+        if t is None:
+            t = mk(*args)
+            self.mTermCache[key] = t
+        return t
+
+    def binOp(self, op, mk, prep=None):
+        rhs = self.mStack.pop()
+        lhs = self.mStack.pop()
+        key = (op, lhs.get_id(), rhs.get_id())
+        t = self.mTermCache.get(key)
+        if t is None:
+            if prep is not None:
+                lhs, rhs = prep(lhs, rhs)
+            t = mk(lhs, rhs)
+            self.mTermCache[key] = t
+        self.mStack.push(t)
+
+    def unOp(self, key, mk):
+        exp = self.mStack.pop()
+        self.mStack.push(self.cached(key + (exp.get_id(),), mk, exp))
+
     # Types
     def leave_Imm(self, typ):
         assert isinstance(typ.arg, int)
@@ -27,7 +88,8 @@ class BaseEmbedder(NullZ3Embedder):
 
     def leave_Int(self, expr):
         val, size = expr.arg
-        self.mStack.push(BitVecVal(val, size, self.mCtx))
+        self.mStack.push(self.cached(('Int', val, size), BitVecVal, val, size,
+                                     self.mCtx))
 
     def leave_Var(self, expr):
         name, typ = expr.arg
@@ -36,7 +98,8 @@ class BaseEmbedder(NullZ3Embedder):
         assert z3DefSort is not None, \
             "Lookup of undefined variable " + name
         assert z3DefSort == z3ExpectedSort
-        self.mStack.push(Const(z3Name, z3DefSort))
+        self.mStack.push(self.cached(('Var', z3Name), Const, z3Name,
+                                     z3DefSort))
 
     # Expressions
     #   Ternary Ops
@@ -59,59 +122,47 @@ class BaseEmbedder(NullZ3Embedder):
         falseE = self.mStack.pop()
         trueE = self.mStack.pop()
         cond = self.mStack.pop()
-        boolCond = bvToBool(cond, self.mCtx)
-        self.mStack.push(If(boolCond, trueE, falseE, ctx=self.mCtx))
-
-    #   Binary Ops
-    def leave_PLUS(self, expr):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        self.mStack.push(lhs + rhs)
-
-    def leave_MINUS(self, expr):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        self.mStack.push(lhs - rhs)
-
-    def leave_TIMES(self, stmt):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        self.mStack.push(lhs * rhs)
-
-    def leave_DIVIDE(self, stmt):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        self.mStack.push(UDiv(lhs, rhs))
-
-    def leave_SDIVIDE(self, stmt):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        self.mStack.push(lhs / rhs)
-
-    def leave_MOD(self, stmt):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        self.mStack.push(URem(lhs, rhs))
-
-    def leave_SMOD(self, stmt):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        self.mStack.push(lhs % rhs)
-
-    def leave_XOR(self, expr):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        self.mStack.push(lhs ^ rhs)
-
-    def leave_AND(self, expr):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        self.mStack.push(lhs & rhs)
-
-    def leave_OR(self, expr):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        self.mStack.push(lhs | rhs)
+        ctx = self.mCtx
+        key = ('Ite', cond.get_id(), trueE.get_id(), falseE.get_id())
+        self.mStack.push(self.cached(
+            key, lambda: If(bvToBool(cond, ctx), trueE, falseE, ctx=ctx)))
+
+    #   Binary Ops and Comparisons
+    def visit_BinOp(self, expr):
+        """ Generic handler of every BinOp through BINOPS. Operands that are
+            plain Ints/Vars are built in place rather than pushed on and
+            popped off the stack.
+        """
+        mk, prep, isPred = BINOPS[expr.constr]
+        lhs = self.operand(expr.arg[0])
+        rhs = self.operand(expr.arg[1])
+        key = (expr.constr, lhs.get_id(), rhs.get_id())
+        t = self.mTermCache.get(key)
+        if t is None:
+            if prep is not None:
+                lhs, rhs = prep(lhs, rhs)
+            t = mk(lhs, rhs)
+            if isPred:
+                t = boolToBV(t, self.mCtx)
+            self.mTermCache[key] = t
+        self.mStack.push(t)
+
+    def operand(self, exp):
+        cls = exp.__class__
+        if cls is Int and self.mFastInt:
+            val, size = exp.arg
+            return self.cached(('Int', val, size), BitVecVal, val, size,
+                               self.mCtx)
+        elif cls is Var and self.mFastVar and isinstance(exp.arg[1], Imm):
+            name, typ = exp.arg
+            z3Name, z3DefSort = self.lookup(name)
+            assert z3DefSort is not None, \
+                "Lookup of undefined variable " + name
+            assert z3DefSort.size() == typ.arg
+            return self.cached(('Var', z3Name), Const, z3Name, z3DefSort)
+
+        self.run(exp)
+        return self.mStack.pop()
 
     # Z3 requires that lhs and rhs of
     # a shift be of the same size.
@@ -127,76 +178,17 @@ class BaseEmbedder(NullZ3Embedder):
         else:
             return (lhs, rhs)
 
-    def leave_RSHIFT(self, expr):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        lhs, rhs = BaseEmbedder.equalize(lhs, rhs)
-        self.mStack.push(LShR(lhs, rhs))
-
-    def leave_LSHIFT(self, expr):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        lhs, rhs = BaseEmbedder.equalize(lhs, rhs)
-        self.mStack.push(lhs << rhs)
-
-    def leave_ARSHIFT(self, expr):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        lhs, rhs = BaseEmbedder.equalize(lhs, rhs)
-        self.mStack.push(lhs >> rhs)
-
-    #  Comparisons
-    def leave_EQ(self, expr):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        boolCmp = lhs == rhs
-        self.mStack.push(boolToBV(boolCmp, self.mCtx))
-
-    def leave_NEQ(self, expr):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        boolCmp = lhs != rhs
-        self.mStack.push(boolToBV(boolCmp, self.mCtx))
-
-    def leave_LT(self, expr):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        boolCmp = ULT(lhs, rhs)
-        self.mStack.push(boolToBV(boolCmp, self.mCtx))
-
-    def leave_LE(self, expr):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        boolCmp = ULE(lhs, rhs)
-        self.mStack.push(boolToBV(boolCmp, self.mCtx))
-
-    def leave_SLT(self, expr):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        boolCmp = lhs < rhs  # < is signed in pyz3 by default
-        self.mStack.push(boolToBV(boolCmp, self.mCtx))
-
-    def leave_SLE(self, expr):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        boolCmp = lhs <= rhs  # <= is signed in pyz3 by default
-        self.mStack.push(boolToBV(boolCmp, self.mCtx))
-
     def leave_Concat(self, expr):
-        rhs = self.mStack.pop()
-        lhs = self.mStack.pop()
-        self.mStack.push(Concat(lhs, rhs))
+        self.binOp('Concat', Concat)
 
     #   Unary Ops
     def leave_NEG(self, expr):
         assert isinstance(expr.arg, Exp)
-        expr = self.mStack.pop()
-        self.mStack.push(-expr)
+        self.unOp(('NEG',), lambda exp: -exp)
 
     def leave_NOT(self, expr):
         assert isinstance(expr.arg, Exp)
-        expr = self.mStack.pop()
-        self.mStack.push(~expr)
+        self.unOp(('NOT',), lambda exp: ~exp)
 
     #   Casts Ops
     def leave_HIGH(self, expr):
@@ -204,22 +196,22 @@ class BaseEmbedder(NullZ3Embedder):
             type(expr.arg[0]) == int and\
             isinstance(expr.arg[1], Exp)
         numBits = expr.arg[0]
-        expr = self.mStack.pop()
-        width = expr.sort().size()
-        self.mStack.push(Extract(width-1, width-numBits, expr))
+
+        def high(exp):
+            width = exp.sort().size()
+            return Extract(width-1, width-numBits, exp)
+        self.unOp(('HIGH', numBits), high)
 
     def leave_LOW(self, expr):
         assert len(expr.arg) == 2 and\
             type(expr.arg[0]) == int and\
             isinstance(expr.arg[1], Exp)
         numBits = expr.arg[0]
-        expr = self.mStack.pop()
-        self.mStack.push(Extract(numBits-1, 0, expr))
+        self.unOp(('LOW', numBits), lambda exp: Extract(numBits-1, 0, exp))
 
     def leave_Extract(self, expr):
         hb, lb, _ = expr.arg
-        expr = self.mStack.pop()
-        self.mStack.push(Extract(hb, lb, expr))
+        self.unOp(('Extract', hb, lb), lambda exp: Extract(hb, lb, exp))
 
     def leave_Unknown(self, expr):
         assert len(expr.arg) == 2
@@ -228,15 +220,15 @@ class BaseEmbedder(NullZ3Embedder):
 
     def leave_UNSIGNED(self, expr):
         size, _ = expr.arg
-        exp = self.mStack.pop()
         # TODO: Is this the correct z3 primitive?
-        self.mStack.push(ZeroExt(size - exp.sort().size(), exp))
+        self.unOp(('UNSIGNED', size),
+                  lambda exp: ZeroExt(size - exp.sort().size(), exp))
 
     def leave_SIGNED(self, expr):
         size, _ = expr.arg
-        exp = self.mStack.pop()
         # TODO: Is this the correct z3 primitive?
-        self.mStack.push(SignExt(size - exp.sort().size(), exp))
+        self.unOp(('SIGNED', size),
+                  lambda exp: SignExt(size - exp.sort().size(), exp))
 
     #   Mem Ops
     def leave_Load(self, expr):
@@ -251,13 +243,25 @@ class BaseEmbedder(NullZ3Embedder):
             size >= memV.sort().range().size() and \
             eq(off.sort(), memV.sort().domain())
 
+        if self.lazyMemory:
+            val, memV = self.forwardLoad(memV, off, size)
+            if val is not None:
+                self.mStack.push(val)
+                return
+
+        self.mStack.push(self.cached(
+            ('Load', memV.get_id(), off.get_id(), size), self.loadBytes,
+            memV, off, size))
+
+    def loadBytes(self, memV, off, size):
+        """ Concat of the size/8 bytes of memV at off """
         # Least signifficant first
         byts = [Select(memV, off + idx) for idx in range(0, size/8)]
         if (len(byts) == 1):
-            self.mStack.push(byts[0])  # Select expects lsb last
+            return byts[0]
         else:
             # Select expects lsb last
-            self.mStack.push(Concat(*reversed(byts)))
+            return Concat(*reversed(byts))
 
     def leave_Store(self, expr):
         _, _, _, endianness, size = expr.arg
@@ -273,10 +277,125 @@ class BaseEmbedder(NullZ3Embedder):
             size == value.sort().size() and \
             eq(off.sort(), memV.sort().domain())
 
-        byts = [Extract((idx+1)*8-1, idx*8, value) for idx in range(0, size/8)]
+        if self.lazyMemory:
+            key = ('LazyStore', memV.get_id(), off.get_id(), value.get_id(),
+                   size)
+            res = self.cached(key, self.lambdaStore, memV, off, value, size)
+            self.mStores[res.get_id()] = (memV, off, value, size)
+            self.mStack.push(res)
+            return
+
+        key = ('Store', memV.get_id(), off.get_id(), value.get_id(), size)
+        self.mStack.push(self.cached(key, self.storeBytes, memV, off, value,
+                                     size))
+
+    def storeBytes(self, memV, off, value, size):
+        """ memV with the size/8 bytes of value stored at off """
+        byts = [Extract((idx+1)*8-1, idx*8, value)
+                for idx in range(0, size/8)]
         for (i, b) in enumerate(byts):
             memV = Update(memV, off + i, b)
-        self.mStack.push(memV)
+        return memV
+
+    def lambdaStore(self, memV, off, value, size):
+        """ memV with the size bit value stored at off, as one lambda term
+            (lambda a. if a - off < size/8 then byte a - off of value else
+            memV[a]). A single byte is just an Update.
+        """
+        assert memV.sort().range().size() == 8
+        if size == 8:
+            return Update(memV, off, value)
+
+        addr = Const('mem.addr', memV.sort().domain())
+        idx = addr - off
+        width = idx.sort().size()
+        if size > width:
+            shift = ZeroExt(size - width, idx)
+        elif size < width:
+            shift = Extract(size - 1, 0, idx)
+        else:
+            shift = idx
+        byte = Extract(7, 0, LShR(value, shift * 8))
+        return Lambda([addr], If(ULT(idx, size / 8), byte,
+                                 Select(memV, addr)))
+
+    def storeOf(self, memV):
+        """ (memory, off, value, size) of the lazy store memV is the result
+            of (looking through SSA copies), or None
+        """
+        while memV is not None:
+            st = self.mStores.get(memV.get_id())
+            if st is not None:
+                return st
+            memV = self.definition(memV)
+        return None
+
+    def splitOffset(self, t):
+        """ (base, c) such that t == base + c, looking through the
+            definitions of SSA variables (e.g. RSP.2 == RSP.1 - 8). base is
+            None for constants.
+        """
+        c = 0
+        while True:
+            if is_bv_value(t):
+                return (None, c + t.as_long())
+
+            isAdd = is_app_of(t, Z3_OP_BADD)
+            if (isAdd or is_app_of(t, Z3_OP_BSUB)) and \
+               len(t.children()) == 2:
+                lhs, rhs = t.children()
+                if is_bv_value(rhs):
+                    c += rhs.as_long() if isAdd else -rhs.as_long()
+                    t = lhs
+                    continue
+                if isAdd and is_bv_value(lhs):
+                    c += lhs.as_long()
+                    t = rhs
+                    continue
+
+            defn = self.definition(t)
+            if defn is None:
+                return (t, c)
+            t = defn
+
+    def offsetDiff(self, a, b):
+        """ a - b as a (signed) python int if it is a constant, else None """
+        baseA, cA = self.splitOffset(a)
+        baseB, cB = self.splitOffset(b)
+        if (baseA is None) != (baseB is None) or \
+           (baseA is not None and not eq(baseA, baseB)):
+            return None
+        width = a.sort().size()
+        d = (cA - cB) % (1 << width)
+        return d - (1 << width) if d >= (1 << (width - 1)) else d
+
+    def forwardLoad(self, memV, off, size):
+        """ Try to read the size bits at off directly from the stores memV is
+            built from. Returns (value, mem). value is the loaded value, or
+            None if it can't be forwarded, in which case the load has to
+            read from mem - the oldest memory that differs from memV only by
+            stores that don't overlap the load.
+        """
+        while True:
+            st = self.storeOf(memV)
+            if st is None:
+                return (None, memV)
+            prevMem, stOff, value, stSize = st
+            diff = self.offsetDiff(off, stOff)
+            if diff is None:
+                return (None, memV)
+
+            lo = diff * 8
+            hi = lo + size
+            if lo >= 0 and hi <= stSize:
+                if lo == 0 and hi == stSize:
+                    return (value, memV)
+                return (self.cached(('Extract', hi - 1, lo, value.get_id()),
+                                    Extract, hi - 1, lo, value), memV)
+            elif hi <= 0 or lo >= stSize:
+                memV = prevMem
+            else:
+                return (None, memV)  # Partial overlap
 
     # Stmts
     def visit_Move(self, stmt):
@@ -300,11 +419,21 @@ class BaseEmbedder(NullZ3Embedder):
         self.pushScope(**{newBindingName: expr})
         return True
 
+    def runBranch(self, stmts):
+        """ Run an If branch: a single Stmt or a (possibly empty) tuple of
+            them, which run itself would skip as not being an ADT
+        """
+        if isinstance(stmts, tuple):
+            for s in stmts:
+                self.run(s)
+        else:
+            self.run(stmts)
+
     def visit_If(self, stmt):
         cond, if_stmt, else_stmt = stmt.arg
         assert isinstance(cond, Exp) and\
-            isinstance(if_stmt, Stmt) or isinstance(if_stmt, tuple) and\
-            isinstance(else_stmt, Stmt) or isinstance(else_stmt, tuple)
+            isinstance(if_stmt, (Stmt, tuple)) and\
+            isinstance(else_stmt, (Stmt, tuple))
 
         # Get the condition
         self.run(cond)
@@ -316,14 +445,14 @@ class BaseEmbedder(NullZ3Embedder):
         # run on if branch
         trueCond = bvToBool(z3Cond, ctx=self.mCtx)
         self.pushBranchScope('.if_true', trueCond, beforeIf)
-        self.run(if_stmt)
+        self.runBranch(if_stmt)
 
         endIfStmt = self.scopeMarker()
 
         # run on else branch (reading from current position on stack)
         falseCond = Not(trueCond, ctx=self.mCtx)
         self.pushBranchScope('.if_false', falseCond, beforeIf)
-        self.run(else_stmt)
+        self.runBranch(else_stmt)
 
         endElseStmt = self.scopeMarker()
 
@@ -331,3 +460,29 @@ class BaseEmbedder(NullZ3Embedder):
 
     def leave_CpuExn(self, stmt):
         self.pushScope(CPUEXN=BitVecVal(1, 1, ctx=self.mCtx))
+
+
+# BIL binary operator -> (z3 constructor, operand preparation, whether the
+# result is a predicate to be turned into a 1-bit vector)
+BINOPS = {
+    'PLUS': (lambda lhs, rhs: lhs + rhs, None, False),
+    'MINUS': (lambda lhs, rhs: lhs - rhs, None, False),
+    'TIMES': (lambda lhs, rhs: lhs * rhs, None, False),
+    'DIVIDE': (UDiv, None, False),
+    'SDIVIDE': (lambda lhs, rhs: lhs / rhs, None, False),
+    'MOD': (URem, None, False),
+    'SMOD': (lambda lhs, rhs: lhs % rhs, None, False),
+    'XOR': (lambda lhs, rhs: lhs ^ rhs, None, False),
+    'AND': (lambda lhs, rhs: lhs & rhs, None, False),
+    'OR': (lambda lhs, rhs: lhs | rhs, None, False),
+    'RSHIFT': (LShR, BaseEmbedder.equalize, False),
+    'LSHIFT': (lambda lhs, rhs: lhs << rhs, BaseEmbedder.equalize, False),
+    'ARSHIFT': (lambda lhs, rhs: lhs >> rhs, BaseEmbedder.equalize, False),
+    'EQ': (lambda lhs, rhs: lhs == rhs, None, True),
+    'NEQ': (lambda lhs, rhs: lhs != rhs, None, True),
+    'LT': (ULT, None, True),
+    'LE': (ULE, None, True),
+    # < and <= are signed in pyz3 by default
+    'SLT': (lambda lhs, rhs: lhs < rhs, None, True),
+    'SLE': (lambda lhs, rhs: lhs <= rhs, None, True),
+}
@@ -0,0 +1,65 @@
+from z3 import Context
+from .embedder import visitBlock
+
+
+class PooledContext(object):
+    """ A long-lived z3 Context together with the arch state tables (sorts
+        and .initial constants) of each embedder class used in it, so those
+        are built once per context rather than once per instruction.
+    """
+    def __init__(self):
+        self.mCtx = Context()
+        self.mTables = {}
+        self.mUses = 0
+
+    def archTables(self, visitor_class):
+        tables = self.mTables.get(visitor_class)
+        if tables is None:
+            tables = visitor_class.makeArchTables(self.mCtx)
+            self.mTables[visitor_class] = tables
+        return tables
+
+
+class ContextPool(object):
+    """ Pool of PooledContexts. Embedding many instructions through a pool
+        avoids setting up a new Context and arch state per instruction.
+
+        Terms accumulate in a context for as long as it lives, so a context
+        is retired (and left to the garbage collector once the caller drops
+        its assertions) after maxUses embeddings.
+
+        The pool numbers the scope nodes of all embeddings through it,
+        starting at firstId, so no two of them use the same SSA name and
+        their assertions can be mixed in one solver (or their SMT-LIB2
+        renderings parsed into one context).
+
+        A pool is not thread-safe - use one per thread or process.
+    """
+    def __init__(self, maxUses=10000, firstId=0):
+        self.mFree = []
+        self.mMaxUses = maxUses
+        self.mNextId = firstId
+
+    def acquire(self):
+        if len(self.mFree) > 0:
+            return self.mFree.pop()
+        return PooledContext()
+
+    def release(self, pctx):
+        if pctx.mUses < self.mMaxUses:
+            self.mFree.append(pctx)
+
+    def embed(self, bil, visitor_class, outputs=None):
+        return self.embedBlock([bil], visitor_class, outputs)
+
+    def embedBlock(self, bils, visitor_class, outputs=None):
+        pctx = self.acquire()
+        try:
+            pctx.mUses += 1
+            with visitBlock(bils, visitor_class, pctx.mCtx,
+                            pctx.archTables(visitor_class),
+                            self.mNextId) as visitor:
+                self.mNextId = visitor.mNextId
+                return visitor.extract(outputs)
+        finally:
+            self.release(pctx)
@@ -1,9 +1,16 @@
 from bap import disasm
-from bap.adt import Visitor, visit
+from bap.rpc import get_instance, parse_insn, ServerError
+import bap.rpc as rpc
+from json import JSONDecoder
+from mmap import mmap
+from bap.adt import ADT, Visitor, visit
+import bap.bil
+from bap.bil import Var
 from ..util import flatten
 from z3 import If, eq, Const, And, BitVecRef, ArrayRef, BitVecNumRef, \
-        BitVecVal, BitVecSort, Context
+        BitVecVal, BitVecSort, Context, is_var, is_const
 from re import compile
+import os
 
 
 def boolToBV(boolExp, ctx):
@@ -16,8 +23,183 @@ def bvToBool(bvExp, ctx):
     return bvExp == BitVecVal(1, 1, ctx)
 
 
-def bitsToBil(bits, target='x86-64'):
-    return flatten([x.bil for x in disasm(bits.toBinStr(), arch=target)])
+def toBinStr(bits):
+    """ Raw bytes of either a Bits or a buffer/memoryview slice of memory
+        (e.g. as yielded by lib.sources.sweep)
+    """
+    if isinstance(bits, memoryview):
+        return bits.tobytes()
+    elif isinstance(bits, buffer):
+        return str(bits)
+    return bits.toBinStr()
+
+
+def bitsToBil(bits, target='x86-64', cache=None):
+    """ Lift bits (a Bits or a buffer of raw bytes) to a list of BIL
+        statements. If cache (a LiftCache) is given, it is consulted first
+        and updated on a miss.
+    """
+    binStr = toBinStr(bits)
+    if cache is not None:
+        bil = cache.get(binStr, target)
+        if bil is not None:
+            return bil
+
+    bil = flatten([x.bil for x in disasm(binStr, arch=target)])
+    if cache is not None:
+        cache.put(binStr, target, bil)
+    return bil
+
+
+def bitsToBils(bits, target='x86-64', addr=0):
+    """ Lift a byte range holding a sequence of instructions (e.g. a basic
+        block) loaded at addr. Returns one list of BIL statements per
+        instruction, in order, as expected by visitBlock/embedBlock.
+    """
+    return [insn.bil for insn in disasm(toBinStr(bits), arch=target,
+                                        addr=addr)]
+
+
+# bap.rpc maps every chunk through a single 4096 byte window of its temp file
+MAX_BATCH_BYTES = 4096
+# Cache hits take no room in a batch, but are held back until it's flushed
+MAX_BATCH_INSNS = 4096
+
+
+def _call(bap, reqs):
+    """ POST all reqs to bap-server in a single HTTP request and return the
+        replies grouped per request (matched on the id bap.dumps assigns).
+    """
+    text = rpc.request.post(bap.url,
+                            data=(bap.dumps(r) for r in reqs)).text
+    dec = JSONDecoder()
+    byId = {}
+    pos = 0
+    while True:
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        if pos >= len(text):
+            break
+        msg, pos = dec.raw_decode(text, pos)
+        byId.setdefault(str(msg.get('id')), []).append(msg)
+
+    res = [byId.get(str(r['id']), []) for r in reqs]
+    if any(len(msgs) == 0 for msgs in res):
+        raise Exception("bap-server didn't reply to every batched request")
+    return res
+
+
+def _replyOrError(msgs, field):
+    for m in msgs:
+        if field in m:
+            return (m, None)
+    return (None, ServerError(msgs[0]))
+
+
+def _liftBatch(binStrs, target):
+    """ Lift a batch of encodings with one round trip per bap-server request
+        kind. All encodings are written back to back into bap's temp file,
+        and each one is loaded as its own memory chunk at address 0 (so the
+        BIL is identical to what bitsToBil produces). Returns a list of
+        (bil, err) in input order.
+    """
+    bap = get_instance()
+    data = ''.join(binStrs)
+    assert len(data) <= MAX_BATCH_BYTES
+    os.ftruncate(bap.temp.fileno(), MAX_BATCH_BYTES)
+    mm = mmap(bap.temp.fileno(), MAX_BATCH_BYTES)
+    mm.write(data)
+    mm.close()
+
+    loadReqs = []
+    off = 0
+    for b in binStrs:
+        loadReqs.append({'load_memory_chunk': {
+            'url': 'mmap://{0}?offset={1}&length={2}'.format(
+                bap.temp.name, off, len(b)),
+            'arch': target,
+            'addr': '0x0'}})
+        off += len(b)
+
+    results = [None] * len(binStrs)
+    resources = []
+    for (i, msgs) in enumerate(_call(bap, loadReqs)):
+        rep, err = _replyOrError(msgs, 'resource')
+        if err is not None:
+            results[i] = (None, err)
+        else:
+            resources.append((i, rep['resource']))
+
+    insnReqs = [{'get_insns': {'resource': r, 'arch': target}}
+                for (_, r) in resources]
+    for ((i, _), msgs) in zip(resources, _call(bap, insnReqs)):
+        rep, err = _replyOrError(msgs, 'insns')
+        if err is not None:
+            results[i] = (None, err)
+            continue
+        try:
+            insns = [parse_insn(js) for js in rep['insns']]
+            results[i] = (flatten([x.bil for x in insns]), None)
+        except Exception, e:
+            results[i] = (None, e)
+
+    return results
+
+
+def bitsToBilMany(bitsIter, target='x86-64', cache=None,
+                  batchBytes=MAX_BATCH_BYTES, batchInsns=MAX_BATCH_INSNS):
+    """ Lift many instructions with one bap-server round trip per batch of up
+        to batchBytes bytes and batchInsns instructions (cache hits
+        included). Yields (bits, bil, err) in input order, where exactly one
+        of bil/err is None, so a single bad encoding doesn't fail the rest
+        of the batch. If the batched protocol itself fails, the batch is
+        retried one instruction at a time.
+    """
+    batchBytes = min(batchBytes, MAX_BATCH_BYTES)
+
+    def flush(batch):
+        misses = [i for (i, (_, _, bil)) in enumerate(batch) if bil is None]
+        lifted = {}
+        if misses:
+            try:
+                res = _liftBatch([batch[i][1] for i in misses], target)
+            except Exception:
+                res = []
+                for i in misses:
+                    try:
+                        res.append((bitsToBil(batch[i][0], target), None))
+                    except Exception, e:
+                        res.append((None, e))
+            lifted = dict(zip(misses, res))
+
+        for (i, (bits, binStr, bil)) in enumerate(batch):
+            if i in lifted:
+                bil, err = lifted[i]
+                if err is None and cache is not None:
+                    cache.put(binStr, target, bil)
+                yield (bits, bil, err)
+            else:
+                yield (bits, bil, None)
+
+    batch = []
+    batchSize = 0
+    for bits in bitsIter:
+        binStr = toBinStr(bits)
+        bil = cache.get(binStr, target) if cache is not None else None
+        full = len(batch) >= batchInsns or \
+            (bil is None and batchSize + len(binStr) > batchBytes)
+        if batch and full:
+            for r in flush(batch):
+                yield r
+            batch = []
+            batchSize = 0
+
+        batch.append((bits, binStr, bil))
+        if bil is None:
+            batchSize += len(binStr)
+
+    for r in flush(batch):
+        yield r
 
 
 class Stack(list):
@@ -26,22 +208,36 @@ class Stack(list):
 
 
 def z3Ids(z3Term):
-    if len(z3Term.children()) == 0:
-            if (isinstance(z3Term, BitVecRef) or
-               isinstance(z3Term, ArrayRef)) and \
-               not isinstance(z3Term, BitVecNumRef):
-                return set([(z3Term.decl().name(), z3Term.sort())])
-            else:
-                return set()
-    else:
-        return reduce(lambda acc, el:    acc.union(z3Ids(el)),
-                      z3Term.children(),
-                      set())
+    """ Free (name, sort) constants of z3Term in first-seen (pre-)order.
+        Walks the term as a DAG with an explicit stack, so shared subterms
+        are only visited once.
+    """
+    res = []
+    seen = set()
+    stack = [z3Term]
+    while len(stack) > 0:
+        t = stack.pop()
+        tId = t.get_id()
+        if tId in seen:
+            continue
+        seen.add(tId)
+
+        children = t.children()
+        if len(children) == 0:
+            if is_var(t):
+                continue  # Bound by a lambda/quantifier
+            if (isinstance(t, BitVecRef) or isinstance(t, ArrayRef)) and \
+               not isinstance(t, BitVecNumRef):
+                res.append((t.decl().name(), t.sort()))
+        else:
+            stack.extend(reversed(children))
+    return res
 
 
 ssaRE = compile("(.*)\.([0-9]*)")
 initialRE = compile("(.*)\.initial*")
 unknownRE = compile("unknown_[0-9]*")
+paramRE = compile("imm_[0-9]*")
 
 
 def unssa(name):
@@ -58,128 +254,318 @@ def isUnknown(name):
     return unknownRE.match(name) is not None
 
 
-class StmtNode:
-    sId = 0
+def paramName(k):
+    """ Name of the k-th symbolic immediate of a template (see TemplateCache)
+    """
+    return "imm_" + str(k)
 
-    def __init__(self, parents):
+
+def isParam(name):
+    return paramRE.match(name) is not None
+
+
+class StmtNode(object):
+    """ A scope in an embedder's scope graph. nodeId is allocated by the
+        owning embedder (see Z3Embedder.newId) and is unique within it.
+
+        Nodes are slotted, as large instructions create thousands of them.
+        The sorts of arch state names are never stored per node: they are
+        read from archSorts (see makeArchTables), which all nodes of an
+        embedder share. mSort only holds the sorts of other names (and is
+        None until there is one).
+    """
+    __slots__ = ('mId', 'mDef', 'mSort', 'mArchSorts', 'mResolved',
+                 'mParents', 'mSplitSrc', 'mFullPrefix', 'mPathCond',
+                 'mSSASuffix', 'mPathCondExpr')
+
+    def __init__(self, nodeId, parents, prefix="", cond=None,
+                 splitSrc=None, archSorts=None):
         self.mDef = {}
-        self.mSort = {}
-        self.mPrefix = ""
-        self.mCond = []
+        self.mSort = None
+        self.mArchSorts = archSorts if archSorts is not None else \
+            parents[0].mArchSorts
+        self.mResolved = {}
         # Assert simpler tree structures - only 2-way branch/join from ifs
         assert (len(parents) <= 2)
         self.mParents = parents
-        self.mSplitSrc = None
-        self.mId = StmtNode.sId
-        StmtNode.sId += 1
-
-    def lookupDef(self, name, cache=False):
-        if name in self.mDef:
-            return self
-        elif len(self.mParents) == 1:
-            return self.mParents[0].lookupDef(name)
-        elif len(self.mParents) > 1:
-            defs = set([x.lookupDef(name) for x in self.mParents])
-            if (len(defs) == 1):
-                # If all agree it hasn't been modified in some branch
-                return list(defs)[0]
-            else:
-                # name has been defined independently in different branches.
-                # Need a phi def here
-                # Make sure all definitions have the same sort
-                s = list(defs)[0].mSort[name]
-                for d in defs:
-                    assert eq(s, d.mSort[name])
-
-                self.mDef[name] = defs
-                self.mSort[name] = s
-                return self
+        self.mSplitSrc = splitSrc
+        self.mId = nodeId
+
+        # The full SSA prefix and the path condition from the root only
+        # depend on the dominating node, so compute them once here.
+        if len(parents) == 1:
+            dom = parents[0]
+        elif len(parents) > 1:
+            dom = splitSrc
         else:
-            return None
+            dom = None
 
-    def cond(self, other):
-        if (self == other):
-            return []
-        elif (len(self.mParents) == 1):
-            c = self.mParents[0].cond(other)
-        elif (len(self.mParents) > 1):
-            c = self.mSplitSrc.cond(other)
+        conds = (cond,) if cond is not None else ()
+        if dom is None:
+            self.mFullPrefix = prefix
+            self.mPathCond = conds
         else:
-            assert False, str(other) + " doesn't dominate " + str(self)
+            self.mFullPrefix = dom.mFullPrefix + prefix
+            self.mPathCond = dom.mPathCond + conds
+        self.mSSASuffix = self.mFullPrefix + "." + str(self.mId)
+        self.mPathCondExpr = None
+
+    def lookupDef(self, name):
+        """ Find the node whose definition of name is visible here. Results
+            are cached on every node on the way (a name's reaching definition
+            at a node never changes once the node has children), so repeated
+            lookups are O(1) amortized. Walks iteratively, so long scope
+            chains don't hit the recursion limit.
+        """
+        if name in self.mResolved:
+            return self.mResolved[name]
+        self.resolve(name)
+        return self.mResolved[name]
+
+    def resolve(self, name):
+        """ Resolve name here and at every unresolved node on the way to its
+            definitions. Returns the number of nodes walked.
+        """
+        walked = 0
+        stack = [self]
+        while len(stack) > 0:
+            node = stack[-1]
+            if name in node.mResolved:
+                stack.pop()
+                continue
+
+            if name in node.mDef:
+                res = node
+            elif len(node.mParents) == 0:
+                res = None
+            else:
+                pending = [p for p in node.mParents
+                           if name not in p.mResolved]
+                if len(pending) > 0:
+                    stack.extend(pending)
+                    continue
+                res = node.join(name)
+
+            node.mResolved[name] = res
+            stack.pop()
+            walked += 1
 
-        return c + self.mCond
+        return walked
 
-    def prefix(self):
+    def join(self, name):
+        """ Compute the definition of name at this node from the (already
+            resolved) definitions at its parents
+        """
         if len(self.mParents) == 1:
-            return self.mParents[0].prefix() + self.mPrefix
-        elif len(self.mParents) > 1:
-            return self.mSplitSrc.prefix() + self.mPrefix
+            return self.mParents[0].mResolved[name]
+
+        defs = set([x.mResolved[name] for x in self.mParents])
+        if (len(defs) == 1):
+            # If all agree it hasn't been modified in some branch
+            return list(defs)[0]
         else:
-            return self.mPrefix
+            # name has been defined independently in different branches.
+            # Need a phi def here
+            # Make sure all definitions have the same sort
+            s = list(defs)[0].sort(name)
+            for d in defs:
+                assert eq(s, d.sort(name))
+
+            self.mDef[name] = defs
+            self.setSort(name, s)
+            return self
+
+    def define(self, name, val):
+        self.mDef[name] = val
+        self.setSort(name, val.sort())
+        self.mResolved[name] = self
+
+    def sort(self, name):
+        """ Sort of this node's definition of name """
+        if self.mSort is not None:
+            s = self.mSort.get(name)
+            if s is not None:
+                return s
+        return self.mArchSorts[name]
+
+    def setSort(self, name, s):
+        """ Record the sort of name, unless name is arch state (whose sort
+            can't change, see visit_Move)
+        """
+        if name in self.mArchSorts:
+            return
+        if self.mSort is None:
+            self.mSort = {}
+        self.mSort[name] = s
+
+    def pathCond(self, ctx):
+        """ Conjunction of all conditions on the path from the root """
+        if self.mPathCondExpr is None:
+            self.mPathCondExpr = And(*(list(self.mPathCond) + [ctx]))
+        return self.mPathCondExpr
 
     def ssa(self, name):
-        return name + self.prefix() + "." + str(self.mId)
+        return name + self.mSSASuffix
 
 
 class StmtDef(StmtNode):
-    def __init__(self, parents, **kwArgs):
-        StmtNode.__init__(self, parents)
-        self.mDef = kwArgs
-        self.mSort = {k: v.sort() for (k, v) in kwArgs.iteritems()}
+    __slots__ = ()
+
+    def __init__(self, nodeId, parents, defs, archSorts=None):
+        StmtNode.__init__(self, nodeId, parents, archSorts=archSorts)
+        self.mDef = defs
+        for (k, v) in defs.iteritems():
+            if k not in self.mArchSorts:
+                self.setSort(k, v.sort())
 
 
 class StmtBranch(StmtNode):
-    def __init__(self, parent, cond, prefix):
-        StmtNode.__init__(self, [parent])
-        self.mCond = [cond]
-        self.mPrefix = prefix
+    __slots__ = ()
+
+    def __init__(self, nodeId, parent, cond, prefix):
+        StmtNode.__init__(self, nodeId, [parent], prefix, cond)
 
 
 class StmtJoin(StmtNode):
-    def __init__(self, parents, splitSrc):
-        StmtNode.__init__(self, parents)
-        self.mSplitSrc = splitSrc
+    __slots__ = ()
+
+    def __init__(self, nodeId, parents, splitSrc):
+        StmtNode.__init__(self, nodeId, parents, splitSrc=splitSrc)
+
+
+def isGenericHandler(cls, name):
+    """ Is handler name of visitor class cls inherited from bap's generic
+        Visitor (e.g. visit_ADT), rather than defined by the embedder?
+    """
+    for c in cls.mro():
+        if name in c.__dict__:
+            return c is Visitor
+    return False
+
+
+def _resolve(cls, adtCls):
+    """ (enters, visit, leaves) handlers of visitor class cls for ADT class
+        adtCls, found with the same rules as Visitor.run: every enter_ and
+        leave_ handler along adtCls' MRO, but only the first visit_ one.
+        A constructor in cls.mustHandle without any visit_/leave_ handler of
+        its own gets cls.unhandled as its visit handler.
+    """
+    names = [c.__name__ for c in adtCls.mro()]
+
+    def handlers(prefix):
+        return [prefix + n for n in names if hasattr(cls, prefix + n)]
+
+    def funcs(names):
+        return tuple(getattr(cls, n).__func__ for n in names)
+
+    visits = handlers('visit_')
+    leaves = handlers('leave_')
+    if adtCls.__name__ in getattr(cls, 'mustHandle', ()) and \
+       len(leaves) == 0 and isGenericHandler(cls, visits[0]):
+        return (funcs(handlers('enter_')), cls.unhandled, ())
+    return (funcs(handlers('enter_')), funcs(visits[:1])[0], funcs(leaves))
+
+
+def dispatchTable(cls):
+    """ Dispatch table of visitor class cls: {ADT class: (enters, visit,
+        leaves)} for every constructor in bap.bil. Built once per class (and
+        stored on it), so Z3Embedder.run doesn't have to look its handlers
+        up by name on every node. A table is never modified once built, so
+        it can be shared between threads.
+    """
+    table = cls.__dict__.get('mDispatchTable')
+    if table is None:
+        table = {}
+        for v in vars(bap.bil).itervalues():
+            if isinstance(v, type) and issubclass(v, ADT):
+                table[v] = _resolve(cls, v)
+        cls.mDispatchTable = table
+    return table
 
 
 class Z3Embedder(Visitor):
     """ Z3 BIL Visitor. Entry points correpsond to
         the ADTs defined in the bap.bil module
+
+        Scope node ids (and so SSA and unknown names) are allocated per
+        embedder, starting at firstId, so embedders share no mutable state
+        and can run concurrently on different threads, each in its own
+        Context. Whoever owns a Context numbers the embedders that use it:
+        an embedder that starts at the mNextId its predecessor ended with
+        picks names that don't clash with the predecessor's, so their
+        assertions can be mixed in one solver (see ContextPool).
+
+        The scope graph and the z3 terms it references live as long as the
+        embedder. release() (or leaving a with block) drops them once the
+        assertions are out, so long runs don't keep every graph alive:
+
+          with visitBil(bil, X86_64Z3Embedder) as e:
+              asserts = e.extract()
     """
-    def __init__(self, ctx):
+    def __init__(self, ctx, archTables=None, firstId=0):
         Visitor.__init__(self)
         self.mStack = Stack()
         self.mNodeMap = {}
         self.mCtx = ctx
+        self.mNextId = firstId
 
-        initialState = {name: Const(name + ".initial", sort)
-                        for name, sort in self.arch_state()}
-        self.mRoot = StmtDef([], **initialState)
+        if archTables is None:
+            archTables = self.makeArchTables(ctx)
+        self.mArchState, initialState, archSorts = archTables
+        self.mRoot = StmtDef(self.newId(), [], dict(initialState), archSorts)
         self.mScope = self.mRoot
         self.mNodeMap = {self.mScope.mId: self.mScope}
-        self.mNumUnknowns = 0
+        self.mFreeDefs = {}
+        self.mDispatch = dispatchTable(type(self))
+
+    def run(self, adt):
+        """ Visitor.run through the class' dispatch table """
+        try:
+            enters, visitFn, leaves = self.mDispatch[adt.__class__]
+        except KeyError:
+            if not isinstance(adt, ADT):
+                return None  # Non ADTs are ignored, as by Visitor.run
+            enters, visitFn, leaves = _resolve(type(self), adt.__class__)
+
+        for fn in enters:
+            r = fn(self, adt)
+            if r is not None:
+                return r
+        r = visitFn(self, adt)
+        if r is not None:
+            return r
+        for fn in leaves:
+            r = fn(self, adt)
+            if r is not None:
+                return r
+        return None
+
+    def newId(self):
+        res = self.mNextId
+        self.mNextId += 1
+        return res
 
     def getFreshUnknown(self, typ):
-        newUnknown = "unknown_" + str(self.mNumUnknowns)
+        # Numbered from the node ids, so unknowns of embedders sharing a
+        # Context don't clash either (see firstId)
+        newUnknown = "unknown_" + str(self.newId())
         z3Unknown = Const(newUnknown, typ)
-        self.mScope.mDef[newUnknown] = z3Unknown
-        self.mScope.mSort[newUnknown] = typ
-
-        self.mNumUnknowns += 1
+        self.mScope.define(newUnknown, z3Unknown)
         return z3Unknown
 
     def pushScope(self, **kwArgs):
         if (len(kwArgs) == 0):
             raise TypeError("Can't push a scope unless we modify some vars")
 
-        self.mScope = StmtDef([self.mScope], **kwArgs)
+        self.mScope = StmtDef(self.newId(), [self.mScope], kwArgs)
         self.mNodeMap[self.mScope.mId] = self.mScope
 
     def pushBranchScope(self, prefix, cond, fromScope):
-        self.mScope = StmtBranch(fromScope, cond, prefix)
+        self.mScope = StmtBranch(self.newId(), fromScope, cond, prefix)
         self.mNodeMap[self.mScope.mId] = self.mScope
 
     def pushJoinScope(self, left, right, split):
-        self.mScope = StmtJoin([left, right], split)
+        self.mScope = StmtJoin(self.newId(), [left, right], split)
         self.mNodeMap[self.mScope.mId] = self.mScope
 
     def popScope(self):
@@ -201,69 +587,217 @@ class Z3Embedder(Visitor):
     def lookup(self, name):
         defNode = self.mScope.lookupDef(name)
         if (defNode):
-            return (defNode.ssa(name), defNode.mSort[name])
+            return (defNode.ssa(name), defNode.sort(name))
         else:
             return (name, None)
 
     def scopeMarker(self):
         return self.mScope
 
-    def extract_one(self, node, name, sort, emitted):
-        if (node, name) in emitted:
-            return []
-
-        ssaName = node.ssa(name)
+    def freeDefs(self, node, name):
+        """ (defining node, name, sort) of every SSA variable that the value
+            of node's definition of name refers to, including the path
+            conditions of phis. Initial values, unknowns and template
+            parameters are not defined in any scope and are left out. Cached
+            per definition.
+        """
+        key = (node.mId, name)
+        if key not in self.mFreeDefs:
+            res = []
+            for (id, idSort) in z3Ids(self.value(node, name,
+                                                 node.sort(name))):
+                if isInitial(id) or isUnknown(id) or isParam(id):
+                    continue
+                defnNode = self.lookupNode(unssa(id)[1])
+                # Strip the node's full suffix rather than trusting unssa,
+                # which can't tell branch prefixes (.if_true) from the name
+                res.append((defnNode, id[:-len(defnNode.mSSASuffix)],
+                            idSort))
+            self.mFreeDefs[key] = res
+        return self.mFreeDefs[key]
+
+    def definition(self, term):
+        """ The value an SSA constant was defined as. None if term isn't an
+            SSA constant, is a phi, or isn't defined in any scope (initial
+            values, unknowns and template parameters).
+        """
+        if not is_const(term):
+            return None
+        id = term.decl().name()
+        if isInitial(id) or isUnknown(id) or isParam(id) or \
+           ssaRE.match(id) is None:
+            return None
+        node = self.mNodeMap.get(unssa(id)[1])
+        if node is None:
+            return None
+        defn = node.mDef.get(id[:-len(node.mSSASuffix)])
+        return None if isinstance(defn, set) else defn
+
+    def phiDefs(self, defn):
+        """ Definitions merged by a phi, in a deterministic order. The one
+            with the weakest path condition comes first and serves as the
+            default value of the phi.
+        """
+        return sorted(defn, key=lambda d: (len(d.mPathCond), d.mId))
+
+    def value(self, node, name, sort):
+        """ z3 value of node's definition of name """
         defn = node.mDef[name]
-        ctx = self.mCtx
-        asserts = []
         if (isinstance(defn, set)):
-            asserts.extend(reduce(
-                    lambda acc, nd:  acc + self.extract_one(nd, name, sort,
-                                                            emitted),
-                    defn, []))
-
-            baseDef = [x for x in defn if len(x.cond(self.mRoot)) == 0]
-            assert len(baseDef) == 1
-            baseDef = baseDef[0]
-            otherDefs = filter(lambda x:    x != baseDef, defn)
-            z3Val = reduce(
-                    lambda exp, d: If(And(*(d.cond(self.mRoot) + [ctx])),
-                                      Const(d.ssa(name), sort),
-                                      exp),
-                    otherDefs,
-                    Const(baseDef.ssa(name), sort))
+            defs = self.phiDefs(defn)
+            z3Val = Const(defs[0].ssa(name), sort)
+            for d in defs[1:]:
+                z3Val = If(d.pathCond(self.mCtx), Const(d.ssa(name), sort),
+                           z3Val)
+            return z3Val
         else:
-            for (id, idSort) in z3Ids(defn):
-                if isInitial(id) or isUnknown(id):
-                    # Initial values and unknowns are not defined in
-                    # any scope
-                    continue
-
-                unssaName, ssaId = unssa(id)
-                defnNode = self.lookupNode(ssaId)
-                asserts.extend(self.extract_one(defnNode,
-                                                unssaName, idSort, emitted))
-            z3Val = defn
-
-        asserts.append(Const(ssaName, sort) == z3Val)
-        emitted.add((node, name))
-        return asserts
+            return defn
+
+    def extract_one(self, node, name, sort, emitted, out=None):
+        """ Append to out the assertions defining node's SSA version of name,
+            preceded by those of all definitions it depends on that aren't in
+            emitted yet. Works off an explicit stack in dependency (post-)
+            order, so deep definition chains don't recurse.
+        """
+        if out is None:
+            out = []
+
+        stack = [(node, name, sort, False)]
+        while len(stack) > 0:
+            node, name, sort, expanded = stack.pop()
+            key = (node, name)
+            if key in emitted:
+                continue
+
+            if expanded:
+                out.append(Const(node.ssa(name), sort) ==
+                           self.value(node, name, sort))
+                emitted.add(key)
+                continue
+
+            stack.append((node, name, sort, True))
+            for (depNode, depName, depSort) in \
+                    reversed(self.freeDefs(node, name)):
+                if (depNode, depName) not in emitted:
+                    stack.append((depNode, depName, depSort, False))
+
+        return out
+
+    def extract(self, names=None, skipUnchanged=True):
+        """ Assertions defining the final values of names (default: the whole
+            arch_state()), sliced back to just the definitions they depend
+            on. With skipUnchanged, names whose final definition is still the
+            initial value are left out rather than asserted equal to their
+            .initial constant. (They still show up if a changed value
+            depends on them.)
+        """
+        if names is None:
+            names = [name for (name, _) in self.arch_state()]
 
-    def extract(self):
         asserts = []
         emitted = set()
-        for (name, sort) in self.arch_state():
-            asserts.extend(self.extract_one(self.mScope.lookupDef(name),
-                                            name, sort, emitted))
+        for name in names:
+            node = self.mScope.lookupDef(name)
+            assert node is not None, "Can't extract undefined " + name
+            if skipUnchanged and node is self.mRoot:
+                continue
+            self.extract_one(node, name, node.sort(name), emitted, asserts)
 
         return asserts
 
-    def arch_state(self):
+    def release(self):
+        """ Drop the scope graph and every z3 term held by the embedder.
+            Nothing but the assertions already extracted survives it.
+        """
+        self.mStack = Stack()
+        self.mNodeMap = {}
+        self.mRoot = None
+        self.mScope = None
+        self.mFreeDefs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    @classmethod
+    def makeArchTables(cls, ctx):
+        """ The (arch state, .initial constants, sorts) tables for ctx, the
+            latter two keyed by name. They only depend on the context, so
+            they can be built once per context and shared by all embedders
+            in it (see ContextPool).
+        """
+        state = cls.archState(ctx)
+        initialState = {name: Const(name + ".initial", sort)
+                        for name, sort in state}
+        return (state, initialState, dict(state))
+
+    @classmethod
+    def archState(cls, ctx):
+        """ List of (name, sort) of the architectural state """
         raise Exception("Abstract")
 
+    def arch_state(self):
+        return self.mArchState
+
 
-def embed(bil, visitor_class):
-    visitor = visitor_class(Context())
+def visitBil(bil, visitor_class, ctx=None, archTables=None, firstId=0):
+    visitor = visitor_class(ctx if ctx is not None else Context(),
+                            archTables, firstId)
     visit(visitor, bil)
     assert len(visitor.mStack) == 0
-    return visitor.extract()
+    return visitor
+
+
+def renameTemps(bil, archNames, suffix):
+    """ bil with suffix appended to the name of every variable that isn't
+        in archNames. Nodes without such variables are kept as they are.
+    """
+    def rename(x):
+        if isinstance(x, Var):
+            name, typ = x.arg
+            return x if name in archNames else Var(name + suffix, typ)
+        elif isinstance(x, ADT):
+            if isinstance(x.arg, tuple):
+                args = tuple(rename(y) for y in x.arg)
+                changed = any(a is not y for (a, y) in zip(args, x.arg))
+                return x.__class__(*args) if changed else x
+            arg = rename(x.arg)
+            return x.__class__(arg) if arg is not x.arg else x
+        elif isinstance(x, (tuple, list)):
+            return type(x)(rename(y) for y in x)
+        return x
+
+    return rename(bil)
+
+
+def visitBlock(bils, visitor_class, ctx=None, archTables=None, firstId=0):
+    """ Visit the BIL of each instruction in bils (a straight-line sequence
+        such as a basic block) with a single embedder. Every instruction
+        starts from the scope the previous one ended in, so the final scope
+        describes the whole sequence in terms of the .initial state.
+
+        Only the arch state carries over. bap reuses temporary names across
+        instructions (possibly at another width), so the temporaries of the
+        k-th instruction (k > 0) are renamed to NAME@k.
+    """
+    visitor = visitor_class(ctx if ctx is not None else Context(),
+                            archTables, firstId)
+    archNames = frozenset(name for (name, _) in visitor.arch_state())
+    for (k, bil) in enumerate(bils):
+        if k > 0:
+            bil = renameTemps(bil, archNames, "@" + str(k))
+        visit(visitor, bil)
+        assert len(visitor.mStack) == 0
+    return visitor
+
+
+def embed(bil, visitor_class, ctx=None, outputs=None):
+    with visitBil(bil, visitor_class, ctx) as visitor:
+        return visitor.extract(outputs)
+
+
+def embedBlock(bils, visitor_class, ctx=None, outputs=None):
+    with visitBlock(bils, visitor_class, ctx) as visitor:
+        return visitor.extract(outputs)
@@ -0,0 +1,226 @@
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
+from z3 import Const, BoolRef, parse_smt2_string
+from z3.z3core import Z3_ast_vector_size, Z3_ast_vector_get
+from .embedder import z3Ids, toBinStr
+import os
+
+
+def toSmt2(asserts):
+    """ Render a list of assertions as a self-contained SMT-LIB2 script
+        (declarations of all free constants followed by the asserts)
+    """
+    decls = OrderedDict()
+    for a in asserts:
+        for (name, sort) in z3Ids(a):
+            decls.setdefault(name, sort)
+
+    lines = ['(declare-fun %s () %s)' % (Const(name, sort).sexpr(),
+                                         sort.sexpr())
+             for (name, sort) in decls.iteritems()]
+    lines.extend('(assert %s)' % a.sexpr() for a in asserts)
+    return ''.join(line + '\n' for line in lines)
+
+
+def splitDecls(text):
+    """ (name, line) of every declaration line in the head of a record """
+    res = []
+    for line in text.splitlines(True):
+        name = line[len('(declare-fun '):line.index(' () ')]
+        res.append((name, line))
+    return res
+
+
+def fromSmt2(text, ctx):
+    """ Parse a script written by toSmt2 back into a list of assertions in
+        ctx
+    """
+    # Everything asserted is a Bool, so wrap the vector's elements directly
+    # rather than letting AstVector work out each element's kind.
+    v = parse_smt2_string(text, ctx=ctx)
+    return [BoolRef(Z3_ast_vector_get(ctx.ref(), v.vector, i), ctx)
+            for i in range(Z3_ast_vector_size(ctx.ref(), v.vector))]
+
+
+class FormulaStore(object):
+    """ Append-only on-disk store of embedded instruction semantics.
+
+        Each record is the SMT-LIB2 script (see toSmt2) of one instruction's
+        assertions, keyed by its byte encoding. Records are appended to
+        <path>.dat, and <path>.idx gets one "<hex encoding> <offset> <length>"
+        line per record, so a single instruction can be read back without
+        scanning the data file. Putting a key again appends a new record
+        that shadows the old one.
+
+        A record is written (and flushed) to the data file before its index
+        line, and index lines pointing past the end of the data file are
+        dropped on load. So a record that didn't fully make it to disk
+        (e.g. the writer was killed) is simply not visible, and is
+        overwritten logically the next time its key is put.
+    """
+    def __init__(self, path):
+        self.mDatPath = path + '.dat'
+        self.mIdxPath = path + '.idx'
+        self.mIndex = OrderedDict()
+        self.mDat = None
+        self.mIdx = None
+        self._loadIndex()
+
+    def _loadIndex(self):
+        try:
+            f = open(self.mIdxPath)
+        except IOError:
+            return
+
+        try:
+            datSize = os.path.getsize(self.mDatPath)
+        except OSError:
+            datSize = 0
+
+        with f:
+            for line in f:
+                fields = line.split()
+                if len(fields) != 3 or not line.endswith('\n'):
+                    continue  # Torn last line
+                key, off, length = fields
+                off, length = int(off), int(length)
+                if off + length > datSize:
+                    continue  # Record didn't reach the data file
+                self.mIndex[unhexlify(key)] = (off, length)
+
+    def _key(self, bits):
+        return bits if isinstance(bits, str) else toBinStr(bits)
+
+    def _truncateTornLine(self, f, blockSize=4096):
+        """ Cut a torn last line (e.g. left by a killed writer) off the
+            index, so the next line doesn't get appended onto it
+        """
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        pos = end
+        while pos > 0:
+            start = max(0, pos - blockSize)
+            f.seek(start)
+            nl = f.read(pos - start).rfind('\n')
+            if nl >= 0:
+                pos = start + nl + 1
+                break
+            pos = start
+        if pos != end:
+            f.truncate(pos)
+        f.seek(pos)
+
+    def _openForAppend(self):
+        if self.mDat is None:
+            self.mDat = open(self.mDatPath, 'ab')
+            self.mDat.seek(0, os.SEEK_END)
+            if not os.path.exists(self.mIdxPath):
+                open(self.mIdxPath, 'wb').close()
+            self.mIdx = open(self.mIdxPath, 'r+b')
+            self._truncateTornLine(self.mIdx)
+
+    def putSmt2(self, bits, text):
+        key = self._key(bits)
+        self._openForAppend()
+        off = self.mDat.tell()
+        self.mDat.write(text)
+        # The record must be in the data file before the index points to it
+        self.mDat.flush()
+        self.mIdx.write('%s %d %d\n' % (hexlify(key), off, len(text)))
+        self.mIndex[key] = (off, len(text))
+
+    def put(self, bits, asserts):
+        self.putSmt2(bits, toSmt2(asserts))
+
+    def getSmt2(self, bits):
+        entry = self.mIndex.get(self._key(bits))
+        if entry is None:
+            return None
+        self.flush()
+        off, length = entry
+        with open(self.mDatPath, 'rb') as f:
+            f.seek(off)
+            return f.read(length)
+
+    def get(self, bits, ctx):
+        """ The assertions stored for bits, parsed into ctx, or None """
+        text = self.getSmt2(bits)
+        return fromSmt2(text, ctx) if text is not None else None
+
+    def loadAll(self, ctx, batchSize=1024):
+        """ Yield (encoding, assertions) for every key, parsed into ctx.
+            Reads the data file front to back, and parses up to batchSize
+            records with a single call into z3 by merging their declarations
+            (a batch is cut short when two records declare a name with
+            different sorts). Records with the same free constants end up
+            sharing them, exactly as if they had been parsed one by one into
+            ctx.
+        """
+        self.flush()
+        entries = sorted((off, length, key)
+                         for (key, (off, length)) in self.mIndex.iteritems())
+
+        def parse(batch, decls):
+            res = fromSmt2(''.join(decls.itervalues()) +
+                           ''.join(body for (_, body, _) in batch), ctx)
+            pos = 0
+            for (key, _, n) in batch:
+                yield (key, res[pos:pos + n])
+                pos += n
+
+        batch = []
+        decls = OrderedDict()
+        with open(self.mDatPath, 'rb', 1 << 20) as f:
+            pos = 0
+            for (off, length, key) in entries:
+                if off != pos:
+                    f.seek(off)
+                text = f.read(length)
+                pos = off + length
+
+                split = text.find('(assert ')
+                if split < 0:
+                    split = len(text)
+                recDecls = splitDecls(text[:split])
+                if len(batch) >= batchSize or \
+                   any(decls.get(name, line) != line
+                       for (name, line) in recDecls):
+                    for r in parse(batch, decls):
+                        yield r
+                    batch = []
+                    decls = OrderedDict()
+
+                decls.update(recDecls)
+                body = text[split:]
+                batch.append((key, body, body.count('\n(assert ') +
+                              (1 if len(body) > 0 else 0)))
+
+        for r in parse(batch, decls):
+            yield r
+
+    def keys(self):
+        return self.mIndex.keys()
+
+    def __contains__(self, bits):
+        return self._key(bits) in self.mIndex
+
+    def __len__(self):
+        return len(self.mIndex)
+
+    def flush(self):
+        if self.mDat is not None:
+            self.mDat.flush()
+            self.mIdx.flush()
+
+    def close(self):
+        if self.mDat is not None:
+            self.mDat.close()
+            self.mIdx.close()
+            self.mDat = None
+            self.mIdx = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
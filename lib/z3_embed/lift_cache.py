@@ -0,0 +1,169 @@
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from hashlib import sha1
+from tempfile import mkstemp
+from errno import ENOENT, EEXIST
+from subprocess import check_output, CalledProcessError
+import os
+
+
+def bapVersion():
+    """ Version of the bap lifter, as reported by the bap frontend (or
+        bap-server, which is built from the same release). Part of every
+        cache key, so that upgrading bap doesn't serve BIL lifted by an
+        older lifter. Falls back to the version of the bap python bindings
+        when neither can be run.
+    """
+    with open(os.devnull, 'w') as devnull:
+        for tool in ['bap', 'bap-server']:
+            try:
+                out = check_output([tool, '--version'], stderr=devnull)
+            except (OSError, CalledProcessError):
+                continue
+            if len(out.strip()) > 0:
+                return tool + ' ' + out.strip()
+
+    try:
+        from pkg_resources import get_distribution
+        return 'python-bap ' + get_distribution('bap').version
+    except Exception:
+        return 'unknown'
+
+
+class LiftCache(object):
+    """ Persistent, content-addressed cache of lifted BIL.
+
+        Entries are keyed by (instruction bytes, target arch, bap version) and
+        stored as one pickled BIL list per file under
+        <path>/<first 2 hex digits of key>/<key>. Files are written to a
+        temporary name and renamed into place, so several processes can share
+        one cache directory without locking - readers either see a complete
+        entry or none at all.
+
+        The total size of the cache is kept under maxBytes by evicting the
+        least recently used entries (hits refresh an entry's mtime).
+    """
+    def __init__(self, path, maxBytes=1 << 30, version=None):
+        self.mPath = os.path.abspath(path)
+        self.mMaxBytes = maxBytes
+        self.mVersion = version if version is not None else bapVersion()
+        self.mBytes = None  # Lazily computed on first put
+        self.mHits = 0
+        self.mMisses = 0
+        self._mkdir(self.mPath)
+
+    @staticmethod
+    def _mkdir(path):
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno != EEXIST:
+                raise
+
+    def key(self, binStr, target):
+        return sha1('\0'.join([self.mVersion, target, binStr])).hexdigest()
+
+    def entryPath(self, key):
+        return os.path.join(self.mPath, key[:2], key)
+
+    def get(self, binStr, target):
+        """ Return the cached BIL list for binStr or None on a miss """
+        path = self.entryPath(self.key(binStr, target))
+        try:
+            with open(path, 'rb') as f:
+                bil = loads(f.read())
+        except (IOError, OSError):
+            self.mMisses += 1
+            return None
+        except Exception:
+            # Truncated or otherwise corrupt entry. Treat it as a miss, the
+            # following put will overwrite it.
+            self.mMisses += 1
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass  # Concurrently evicted. We already have the data.
+        self.mHits += 1
+        return bil
+
+    def put(self, binStr, target, bil):
+        path = self.entryPath(self.key(binStr, target))
+        shardDir = os.path.dirname(path)
+        self._mkdir(shardDir)
+
+        data = dumps(bil, HIGHEST_PROTOCOL)
+        fd, tmpPath = mkstemp(dir=shardDir, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # An existing entry is replaced, so its size no longer counts
+            try:
+                oldSize = os.path.getsize(path)
+            except OSError, e:
+                if e.errno != ENOENT:
+                    raise
+                oldSize = 0
+            os.rename(tmpPath, path)
+        except Exception:
+            try:
+                os.remove(tmpPath)
+            except OSError:
+                pass
+            raise
+
+        if self.mBytes is None:
+            self.mBytes = self.size()
+        else:
+            self.mBytes += len(data) - oldSize
+
+        if self.mBytes > self.mMaxBytes:
+            self.evict()
+
+    def entries(self):
+        """ List (mtime, size, path) for all entries currently on disk """
+        res = []
+        for (dirPath, _, fileNames) in os.walk(self.mPath):
+            for name in fileNames:
+                if name.startswith('.tmp'):
+                    continue
+                path = os.path.join(dirPath, name)
+                try:
+                    st = os.stat(path)
+                except OSError, e:
+                    if e.errno != ENOENT:
+                        raise
+                    continue
+                res.append((st.st_mtime, st.st_size, path))
+        return res
+
+    def size(self):
+        return sum(size for (_, size, _) in self.entries())
+
+    def evict(self, lowWater=0.9):
+        """ Drop least recently used entries until the cache takes up at most
+            lowWater * maxBytes. Other processes may be evicting at the same
+            time, so entries that are already gone are simply skipped.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for (_, size, _) in entries)
+        target = int(self.mMaxBytes * lowWater)
+        for (_, size, path) in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError, e:
+                if e.errno != ENOENT:
+                    raise
+            total -= size
+        self.mBytes = total
+
+    def clear(self):
+        for (_, _, path) in self.entries():
+            try:
+                os.remove(path)
+            except OSError, e:
+                if e.errno != ENOENT:
+                    raise
+        self.mBytes = 0
@@ -9,139 +9,24 @@ class NullZ3Embedder(Z3Embedder):
     """ NullZ3Embedder raises an exception for every type of BIL node.
         Subclass concrete Embedders from this class, so that we fail
         loudly if we forgot to implement something.
-    """
-    def __init__(self, ctx):
-        Z3Embedder.__init__(self, ctx)
-
-    def leave_Imm(self, typ):
-        neverSeen(typ)
-
-    def leave_Mem(self, typ):
-        neverSeen(typ)
-
-    def leave_Int(self, ival):
-        neverSeen(ival)
-
-    def leave_Var(self, var):
-        neverSeen(var)
-
-    # Expressions
-    #   Ternary Ops
-    def visit_Let(self, expr):
-        neverSeen(expr)
-
-    def leave_Ite(self, expr):
-        neverSeen(expr)
-
-    def leave_Extract(self, expr):
-        neverSeen(expr)
-
-    #   Binary Ops
-    def leave_Concat(self, expr):
-        neverSeen(expr)
-
-    def leave_PLUS(self, expr):
-        neverSeen(expr)
-
-    def leave_MINUS(self, expr):
-        neverSeen(expr)
-
-    def leave_TIMES(self, expr):
-        neverSeen(expr)
-
-    def leave_DIVIDE(self, expr):
-        neverSeen(expr)
-
-    def leave_SDIVIDE(self, expr):
-        neverSeen(expr)
-
-    def leave_MOD(self, expr):
-        neverSeen(expr)
-
-    def leave_SMOD(self, expr):
-        neverSeen(expr)
-
-    def leave_LSHIFT(self, expr):
-        neverSeen(expr)
-
-    def leave_RSHIFT(self, expr):
-        neverSeen(expr)
-
-    def leave_ARSHIFT(self, expr):
-        neverSeen(expr)
-
-    def leave_AND(self, expr):
-        neverSeen(expr)
-
-    def leave_OR(self, expr):
-        neverSeen(expr)
-
-    def leave_XOR(self, expr):
-        neverSeen(expr)
 
-    def leave_EQ(self, expr):
-        neverSeen(expr)
-
-    def leave_NEQ(self, expr):
-        neverSeen(expr)
-
-    def leave_LT(self, expr):
-        neverSeen(expr)
-
-    def leave_LE(self, expr):
-        neverSeen(expr)
-
-    def leave_SLT(self, expr):
-        neverSeen(expr)
-
-    def leave_SLE(self, expr):
-        neverSeen(expr)
-
-    #   Unary Ops
-    def leave_NEG(self, expr):
-        neverSeen(expr)
-
-    def leave_NOT(self, expr):
-        neverSeen(expr)
-
-    def leave_Unknown(self, expr):
-        neverSeen(expr)
-
-    #   Casts Ops
-    def leave_UNSIGNED(self, expr):
-        neverSeen(expr)
-
-    def leave_SIGNED(self, expr):
-        neverSeen(expr)
-
-    def leave_HIGH(self, expr):
-        neverSeen(expr)
-
-    def leave_LOW(self, expr):
-        neverSeen(expr)
-
-    #   Mem Ops
-    def leave_Load(self, expr):
-        neverSeen(expr)
-
-    def leave_Store(self, expr):
-        neverSeen(expr)
-
-    # Statements
-    def leave_Move(self, stmt):
-        neverSeen(stmt)
-
-    def leave_Jmp(self, stmt):
-        neverSeen(stmt)
-
-    def leave_Special(self, stmt):
-        neverSeen(stmt)
-
-    def leave_While(self, stmt):
-        neverSeen(stmt)
-
-    def visit_If(self, stmt):
-        neverSeen(stmt)
-
-    def leave_CpuExn(self, stmt):
-        neverSeen(stmt)
+        Rather than a stub per node, every constructor in mustHandle that a
+        subclass has neither a visit_ nor a leave_ handler for dispatches
+        to neverSeen (see dispatchTable).
+    """
+    mustHandle = frozenset([
+        # Types
+        'Imm', 'Mem',
+        # Expressions
+        'Int', 'Var', 'Let', 'Ite', 'Extract', 'Concat',
+        'PLUS', 'MINUS', 'TIMES', 'DIVIDE', 'SDIVIDE', 'MOD', 'SMOD',
+        'LSHIFT', 'RSHIFT', 'ARSHIFT', 'AND', 'OR', 'XOR',
+        'EQ', 'NEQ', 'LT', 'LE', 'SLT', 'SLE',
+        'NEG', 'NOT', 'Unknown', 'UNSIGNED', 'SIGNED', 'HIGH', 'LOW',
+        'Load', 'Store',
+        # Statements
+        'Move', 'Jmp', 'Special', 'While', 'If', 'CpuExn'])
+    unhandled = staticmethod(lambda self, adt: neverSeen(adt))
+
+    def __init__(self, ctx, archTables=None, firstId=0):
+        Z3Embedder.__init__(self, ctx, archTables, firstId)
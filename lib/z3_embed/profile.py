@@ -0,0 +1,161 @@
+from collections import OrderedDict
+from json import dumps
+from timeit import default_timer
+from .embedder import bitsToBil, isGenericHandler
+
+# Z3Embedder methods timed on top of every enter_/visit_/leave_ handler.
+# Visitor.run covers the generic dispatch, lookup covers StmtNode.lookupDef
+# and freeDefs covers z3Ids. Times are inclusive of nested calls to other
+# methods, but a method re-entered while it is running (e.g. run, through
+# the handlers) only counts the time of its outermost call.
+HOT_METHODS = ['run', 'lookup', 'freeDefs', 'value', 'extract_one',
+               'extract']
+
+
+def _timed(prof, key, fn):
+    def wrapper(*args, **kwArgs):
+        depth = prof.mActive.get(key, 0)
+        prof.mActive[key] = depth + 1
+        t = default_timer()
+        try:
+            return fn(*args, **kwArgs)
+        finally:
+            prof.mActive[key] = depth
+            prof.add(key, 0 if depth else default_timer() - t)
+    wrapper.__name__ = fn.__name__
+    return wrapper
+
+
+def scopeStats(embedder):
+    """ (nodes, phis) of embedder's scope graph """
+    phis = 0
+    for node in embedder.mNodeMap.itervalues():
+        phis += sum(1 for d in node.mDef.itervalues() if isinstance(d, set))
+    return (len(embedder.mNodeMap), phis)
+
+
+class Profiler(object):
+    """ Opt-in instrumentation of the embedder.
+
+        embedderClass(cls) returns a subclass of cls whose visitor handlers
+        and HOT_METHODS record their call counts and times here, and which
+        records the shape of its scope graph on every extract, along with
+        the most nodes any of its definition lookups walked. Code that
+        isn't handed such a class, or lifts through the plain bitsToBil,
+        runs exactly as before, so profiling costs nothing when disabled.
+
+        Stats accumulate across any number of embeddings, can be merged
+        (e.g. from several worker processes) and are dumped as JSON.
+    """
+    def __init__(self):
+        self.mTimers = {}
+        self.mScopes = OrderedDict([('embeds', 0), ('nodes', 0),
+                                    ('phis', 0), ('maxLookup', 0)])
+        self.mClasses = {}
+        # Timed methods running right now -> their nesting depth
+        self.mActive = {}
+
+    def add(self, key, seconds, calls=1):
+        t = self.mTimers.get(key)
+        if t is None:
+            self.mTimers[key] = [calls, seconds]
+        else:
+            t[0] += calls
+            t[1] += seconds
+
+    def addScopes(self, embeds, nodes, phis, maxLookup=0):
+        self.mScopes['embeds'] += embeds
+        self.mScopes['nodes'] += nodes
+        self.mScopes['phis'] += phis
+        self.mScopes['maxLookup'] = max(self.mScopes['maxLookup'],
+                                        maxLookup)
+
+    def embedderClass(self, visitor_class):
+        cls = self.mClasses.get(visitor_class)
+        if cls is not None:
+            return cls
+
+        prof = self
+
+        def resolve(embedder, name):
+            # lookupDef doesn't report how far it walked. Resolving name
+            # here first, with the same walk, leaves lookupDef as it is
+            # for unprofiled embedders.
+            if name not in embedder.mScope.mResolved:
+                prof.addScopes(0, 0, 0, embedder.mScope.resolve(name))
+
+        def lookup(self, name):
+            resolve(self, name)
+            return visitor_class.lookup(self, name)
+
+        def extract(self, names=None, *args, **kwArgs):
+            if names is None:
+                names = [name for (name, _) in self.arch_state()]
+            for name in names:
+                resolve(self, name)
+            return visitor_class.extract(self, names, *args, **kwArgs)
+
+        hooks = {'lookup': lookup, 'extract': extract}
+        attrs = {}
+        for name in dir(visitor_class):
+            # bap's generic handlers (e.g. visit_ADT) stay as they are, so
+            # dispatchTable still sends unhandled constructors to unhandled
+            if isGenericHandler(visitor_class, name):
+                continue
+            if name.split('_', 1)[0] in ('enter', 'visit', 'leave') or \
+               name in HOT_METHODS:
+                attrs[name] = _timed(prof, name,
+                                     hooks.get(name,
+                                               getattr(visitor_class, name)))
+
+        timedExtract = attrs['extract']
+
+        def scopedExtract(self, *args, **kwArgs):
+            res = timedExtract(self, *args, **kwArgs)
+            prof.addScopes(1, *scopeStats(self))
+            return res
+        attrs['extract'] = scopedExtract
+
+        cls = type('Profiled' + visitor_class.__name__, (visitor_class,),
+                   attrs)
+        self.mClasses[visitor_class] = cls
+        return cls
+
+    def bitsToBil(self, bits, target='x86-64', cache=None):
+        t = default_timer()
+        try:
+            return bitsToBil(bits, target, cache)
+        finally:
+            self.add('phase:lift', default_timer() - t)
+
+    def phase(self, name, fn, *args, **kwArgs):
+        """ Call fn, timing it as phase name """
+        return _timed(self, 'phase:' + name, fn)(*args, **kwArgs)
+
+    def merge(self, stats):
+        """ Add the stats of another Profiler (or of its toJSON()) """
+        if isinstance(stats, Profiler):
+            stats = stats.toJSON()
+        for (key, t) in stats['timers'].iteritems():
+            self.add(key, t['seconds'], t['calls'])
+        self.addScopes(*[stats['scopes'][k] for k in self.mScopes])
+
+    def take(self):
+        """ toJSON(), resetting all stats """
+        res = self.toJSON()
+        self.mTimers = {}
+        for k in self.mScopes:
+            self.mScopes[k] = 0
+        return res
+
+    def toJSON(self):
+        timers = OrderedDict(
+            (key, OrderedDict([('calls', calls), ('seconds', secs)]))
+            for (key, (calls, secs)) in sorted(self.mTimers.iteritems(),
+                                               key=lambda x: -x[1][1]))
+        return OrderedDict([('timers', timers),
+                            ('scopes', OrderedDict(self.mScopes))])
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(dumps(self.toJSON(), indent=2) + '\n')
@@ -0,0 +1,197 @@
+from z3 import BitVecVal, BitVecRef, ArrayRef
+from z3.z3types import Ast
+from z3.z3core import Z3_mk_bvadd, Z3_mk_bvsub, Z3_mk_bvmul, \
+    Z3_mk_bvudiv, Z3_mk_bvsdiv, Z3_mk_bvurem, Z3_mk_bvsmod, Z3_mk_bvxor, \
+    Z3_mk_bvand, Z3_mk_bvor, Z3_mk_bvlshr, Z3_mk_bvshl, Z3_mk_bvashr, \
+    Z3_mk_eq, Z3_mk_distinct, Z3_mk_bvult, Z3_mk_bvule, Z3_mk_bvslt, \
+    Z3_mk_bvsle, Z3_mk_bvneg, Z3_mk_bvnot, Z3_mk_extract, Z3_mk_zero_ext, \
+    Z3_mk_sign_ext, Z3_mk_concat, Z3_mk_ite, Z3_mk_select, Z3_mk_store, \
+    Z3_get_sort, Z3_get_bv_sort_size
+from .base_embedder import BaseEmbedder
+
+
+def _mkNe(c, lhs, rhs):
+    args = (Ast * 2)()
+    args[0] = lhs
+    args[1] = rhs
+    return Z3_mk_distinct(c, 2, args)
+
+
+class RawTermsEmbedder(BaseEmbedder):
+    """ BaseEmbedder building its terms directly through the z3 C API.
+
+        The z3py helpers (operators, Extract, If, ...) coerce and sort check
+        their arguments and wrap every node they create, including the
+        intermediate ones (e.g. the Bool inside a comparison, or each step
+        of a Concat). Here nodes are built from the raw AST handles of their
+        operands, and only the node pushed on the stack is wrapped, since
+        scopes, the term cache and extract work on z3py terms.
+
+        The terms are exactly those BaseEmbedder builds, so the assertions
+        of both are identical (down to their AST ids in a shared context).
+
+        z3 only keeps an unwrapped result alive until the next call that
+        returns an AST, so every raw result is consumed by the very next
+        Z3_mk_* call.
+    """
+    def __init__(self, ctx, archTables=None, firstId=0):
+        BaseEmbedder.__init__(self, ctx, archTables, firstId)
+        self.mCtxRef = ctx.ref()
+
+    def num(self, val, size):
+        return self.cached(('Int', val, size), BitVecVal, val, size,
+                           self.mCtx)
+
+    def wrap(self, a):
+        return BitVecRef(a, self.mCtx)
+
+    def bvSize(self, a):
+        return Z3_get_bv_sort_size(self.mCtxRef, Z3_get_sort(self.mCtxRef, a))
+
+    def visit_BinOp(self, expr):
+        mk, equalize, isPred = RAW_BINOPS[expr.constr]
+        lhs = self.operand(expr.arg[0])
+        rhs = self.operand(expr.arg[1])
+        key = (expr.constr, lhs.get_id(), rhs.get_id())
+        t = self.mTermCache.get(key)
+        if t is None:
+            c = self.mCtxRef
+            if isPred:
+                one = self.num(1, 1).as_ast()
+                zero = self.num(0, 1).as_ast()
+                t = self.wrap(Z3_mk_ite(c, mk(c, lhs.as_ast(), rhs.as_ast()),
+                                        one, zero))
+            else:
+                a = lhs.as_ast()
+                b = rhs.as_ast()
+                if equalize:
+                    lhsSize = self.bvSize(a)
+                    rhsSize = self.bvSize(b)
+                    assert lhsSize >= rhsSize, "NYI"
+                    if lhsSize > rhsSize:
+                        t = self.wrap(mk(c, a, Z3_mk_zero_ext(
+                            c, lhsSize - rhsSize, b)))
+                if t is None:
+                    t = self.wrap(mk(c, a, b))
+            self.mTermCache[key] = t
+        self.mStack.push(t)
+
+    def leave_Ite(self, expr):
+        falseE = self.mStack.pop()
+        trueE = self.mStack.pop()
+        cond = self.mStack.pop()
+        key = ('Ite', cond.get_id(), trueE.get_id(), falseE.get_id())
+        t = self.mTermCache.get(key)
+        if t is None:
+            c = self.mCtxRef
+            one = self.num(1, 1).as_ast()
+            a = Z3_mk_ite(c, Z3_mk_eq(c, cond.as_ast(), one), trueE.as_ast(),
+                          falseE.as_ast())
+            t = ArrayRef(a, self.mCtx) if isinstance(trueE, ArrayRef) else \
+                self.wrap(a)
+            self.mTermCache[key] = t
+        self.mStack.push(t)
+
+    def leave_Concat(self, expr):
+        c = self.mCtxRef
+        self.binOp('Concat', lambda lhs, rhs: self.wrap(
+            Z3_mk_concat(c, lhs.as_ast(), rhs.as_ast())))
+
+    def rawUnOp(self, key, mk):
+        exp = self.mStack.pop()
+        key += (exp.get_id(),)
+        t = self.mTermCache.get(key)
+        if t is None:
+            t = self.wrap(mk(self.mCtxRef, exp.as_ast()))
+            self.mTermCache[key] = t
+        self.mStack.push(t)
+
+    #   Unary Ops
+    def leave_NEG(self, expr):
+        self.rawUnOp(('NEG',), Z3_mk_bvneg)
+
+    def leave_NOT(self, expr):
+        self.rawUnOp(('NOT',), Z3_mk_bvnot)
+
+    #   Casts Ops
+    def leave_HIGH(self, expr):
+        numBits = expr.arg[0]
+
+        def high(c, a):
+            width = self.bvSize(a)
+            return Z3_mk_extract(c, width-1, width-numBits, a)
+        self.rawUnOp(('HIGH', numBits), high)
+
+    def leave_LOW(self, expr):
+        numBits = expr.arg[0]
+        self.rawUnOp(('LOW', numBits),
+                     lambda c, a: Z3_mk_extract(c, numBits-1, 0, a))
+
+    def leave_Extract(self, expr):
+        hb, lb, _ = expr.arg
+        self.rawUnOp(('Extract', hb, lb),
+                     lambda c, a: Z3_mk_extract(c, hb, lb, a))
+
+    def leave_UNSIGNED(self, expr):
+        size, _ = expr.arg
+        self.rawUnOp(('UNSIGNED', size), lambda c, a: Z3_mk_zero_ext(
+            c, size - self.bvSize(a), a))
+
+    def leave_SIGNED(self, expr):
+        size, _ = expr.arg
+        self.rawUnOp(('SIGNED', size), lambda c, a: Z3_mk_sign_ext(
+            c, size - self.bvSize(a), a))
+
+    #   Mem Ops
+    def loadBytes(self, memV, off, size):
+        c = self.mCtxRef
+        mem = memV.as_ast()
+        o = off.as_ast()
+        width = off.sort().size()
+        # Every Select has to be wrapped, as it outlives the next call.
+        byts = [self.wrap(Z3_mk_select(c, mem, Z3_mk_bvadd(
+                    c, o, self.num(idx, width).as_ast())))
+                for idx in range(0, size/8)]
+        # Select expects lsb last
+        r = byts[-1].as_ast()
+        for b in reversed(byts[:-1]):
+            r = Z3_mk_concat(c, r, b.as_ast())
+        return self.wrap(r)
+
+    def storeBytes(self, memV, off, value, size):
+        c = self.mCtxRef
+        o = off.as_ast()
+        v = value.as_ast()
+        width = off.sort().size()
+        mem = memV
+        for idx in range(0, size/8):
+            addr = self.wrap(Z3_mk_bvadd(c, o, self.num(idx, width).as_ast()))
+            mem = ArrayRef(Z3_mk_store(
+                c, mem.as_ast(), addr.as_ast(),
+                Z3_mk_extract(c, (idx+1)*8-1, idx*8, v)), self.mCtx)
+        return mem
+
+
+# BIL binary operator -> (Z3_mk_* function, whether the operands' sizes
+# are equalized first, whether the result is a predicate). See BINOPS.
+RAW_BINOPS = {
+    'PLUS': (Z3_mk_bvadd, False, False),
+    'MINUS': (Z3_mk_bvsub, False, False),
+    'TIMES': (Z3_mk_bvmul, False, False),
+    'DIVIDE': (Z3_mk_bvudiv, False, False),
+    'SDIVIDE': (Z3_mk_bvsdiv, False, False),
+    'MOD': (Z3_mk_bvurem, False, False),
+    'SMOD': (Z3_mk_bvsmod, False, False),
+    'XOR': (Z3_mk_bvxor, False, False),
+    'AND': (Z3_mk_bvand, False, False),
+    'OR': (Z3_mk_bvor, False, False),
+    'RSHIFT': (Z3_mk_bvlshr, True, False),
+    'LSHIFT': (Z3_mk_bvshl, True, False),
+    'ARSHIFT': (Z3_mk_bvashr, True, False),
+    'EQ': (Z3_mk_eq, False, True),
+    'NEQ': (_mkNe, False, True),
+    'LT': (Z3_mk_bvult, False, True),
+    'LE': (Z3_mk_bvule, False, True),
+    'SLT': (Z3_mk_bvslt, False, True),
+    'SLE': (Z3_mk_bvsle, False, True),
+}
@@ -0,0 +1,130 @@
+from bap.adt import ADT, visit
+from bap.bil import Int, Var
+from z3 import BitVecSort, BitVecVal, Const, Context, substitute
+from .embedder import paramName
+
+
+def bilShape(bil, archNames=()):
+    """ Split bil into (shape, ints). shape is a hashable rendering of bil
+        with the value of every Int left out, and ints lists those Int nodes
+        in a fixed (pre-)order. Instructions with the same shape (e.g. all
+        `ff 25 <disp32>`) only differ in their immediates/displacements.
+
+        Variables other than archNames are temporaries, which bap names from
+        a counter that keeps running for the life of the server. They are
+        renamed by order of first occurrence, so two lifts of the same
+        instruction have the same shape.
+    """
+    ints = []
+    seen = set()
+    temps = {}
+
+    def shape(x):
+        if isinstance(x, Int):
+            if id(x) not in seen:
+                seen.add(id(x))
+                ints.append(x)
+            return ('Int', x.arg[1])
+        elif isinstance(x, Var) and x.arg[0] not in archNames:
+            name = temps.setdefault(x.arg[0], len(temps))
+            return ('Var', name, shape(x.arg[1]))
+        elif isinstance(x, ADT):
+            return (x.constr, shape(x.arg))
+        elif isinstance(x, (tuple, list)):
+            return tuple(shape(y) for y in x)
+        return x
+
+    return (shape(bil), ints)
+
+
+def templateClass(visitor_class):
+    """ Subclass of visitor_class that embeds every Int as the symbolic
+        parameter paramName(k), k being its index in mParams.
+    """
+    class Template(visitor_class):
+        inlineInts = False
+
+        def leave_Int(self, expr):
+            _, size = expr.arg
+            k = self.mParams[id(expr)]
+            self.mStack.push(Const(paramName(k),
+                                   BitVecSort(size, ctx=self.mCtx)))
+
+    Template.__name__ = 'Template' + visitor_class.__name__
+    return Template
+
+
+class TemplateCache(object):
+    """ Cache of instruction semantics with the immediates abstracted.
+
+        The first instruction of each shape (see bilShape) is embedded with
+        its Ints replaced by symbolic parameters. Any later instruction of
+        the same shape is embedded by substituting its own Int values into
+        the cached assertions, which skips the visitor entirely.
+
+        Instances share the SSA names of their template (temporaries
+        included, whatever they were called in the instance's own BIL), so
+        assertions of two instances of the same template mustn't be mixed
+        in one solver. All templates and instances live in the cache's
+        context.
+
+        At most maxTemplates templates are kept. Once that many are cached,
+        the next miss drops them all and, if the cache created its own
+        context, retires it for a fresh one (like ContextPool), so a long
+        run doesn't keep every term it ever built alive.
+    """
+    def __init__(self, visitor_class, ctx=None, archTables=None,
+                 maxTemplates=10000):
+        self.mOwnCtx = ctx is None
+        self.mCtx = ctx if ctx is not None else Context()
+        self.mVisitorClass = visitor_class
+        self.mClass = templateClass(visitor_class)
+        self.mArchTables = archTables if archTables is not None else \
+            visitor_class.makeArchTables(self.mCtx)
+        self.mArchNames = frozenset(self.mArchTables[2])
+        self.mMaxTemplates = maxTemplates
+        self.mTemplates = {}
+        self.mHits = 0
+        self.mMisses = 0
+
+    def retire(self):
+        """ Drop all templates, and the cache's own context with them """
+        self.mTemplates = {}
+        if self.mOwnCtx:
+            self.mCtx = Context()
+            self.mArchTables = \
+                self.mVisitorClass.makeArchTables(self.mCtx)
+
+    def template(self, bil, ints, outputs=None):
+        """ (assertions, parameters) of bil with ints made symbolic """
+        with self.mClass(self.mCtx, self.mArchTables) as visitor:
+            visitor.mParams = {id(n): k for (k, n) in enumerate(ints)}
+            visit(visitor, bil)
+            assert len(visitor.mStack) == 0
+            params = [Const(paramName(k),
+                            BitVecSort(n.arg[1], ctx=self.mCtx))
+                      for (k, n) in enumerate(ints)]
+            return (visitor.extract(outputs), params)
+
+    def embed(self, bil, outputs=None):
+        shape, ints = bilShape(bil, self.mArchNames)
+        key = (shape, tuple(outputs) if outputs is not None else None)
+        tmpl = self.mTemplates.get(key)
+        if tmpl is None:
+            self.mMisses += 1
+            if len(self.mTemplates) >= self.mMaxTemplates:
+                self.retire()
+            tmpl = self.template(bil, ints, outputs)
+            self.mTemplates[key] = tmpl
+        else:
+            self.mHits += 1
+
+        asserts, params = tmpl
+        if len(params) == 0:
+            return list(asserts)
+        subst = [(p, BitVecVal(n.arg[0], n.arg[1], ctx=self.mCtx))
+                 for (p, n) in zip(params, ints)]
+        return [substitute(a, *subst) for a in asserts]
+
+    def __len__(self):
+        return len(self.mTemplates)
@@ -0,0 +1,97 @@
+from multiprocessing.pool import ThreadPool
+from threading import local, Lock
+from .context_pool import ContextPool
+from .embedder import bitsToBil
+from .formula_store import toSmt2
+
+# Scope node ids available to each worker's ContextPool
+WORKER_IDS = 1 << 32
+
+
+class EmbedThreadPool(object):
+    """ Embeds instructions on a pool of threads sharing one process.
+
+        Every worker thread has its own ContextPool, so each z3 Context and
+        all terms built in it are only ever touched by one thread. Embedders
+        don't share any mutable state (see Z3Embedder), and bap keeps one
+        server connection per thread, so workers can lift as well. z3 runs
+        without the GIL (ctypes releases it around every call), so workers
+        overlap whenever they are inside z3, without the memory cost of a
+        process per worker.
+
+        Since a worker keeps using its contexts, its terms can't be handed
+        to another thread. Instead fn(assertions) is run on the worker and
+        its result is returned, which mustn't hold z3 objects. By default
+        that is the SMT-LIB2 rendering (see toSmt2), which fromSmt2 parses
+        back into the caller's own context. Each worker numbers its scope
+        nodes in a range of its own, so results of different workers can
+        be parsed into the same context without their SSA names clashing.
+
+        Usage:
+          with EmbedThreadPool(X86_64Z3Embedder, threads=4) as pool:
+              for text in pool.map(bils):
+                  asserts = fromSmt2(text, ctx)
+    """
+    def __init__(self, visitor_class, threads=None, maxUses=10000):
+        self.mClass = visitor_class
+        self.mMaxUses = maxUses
+        self.mLocal = local()
+        self.mLock = Lock()
+        self.mWorkers = 0
+        self.mPool = ThreadPool(threads)
+
+    def contextPool(self):
+        """ The calling worker thread's ContextPool """
+        pool = getattr(self.mLocal, 'pool', None)
+        if pool is None:
+            with self.mLock:
+                worker = self.mWorkers
+                self.mWorkers += 1
+            pool = ContextPool(self.mMaxUses, worker * WORKER_IDS)
+            self.mLocal.pool = pool
+        return pool
+
+    def _embed(self, arg):
+        bil, outputs, fn = arg
+        return fn(self.contextPool().embed(bil, self.mClass, outputs))
+
+    def _liftAndEmbed(self, arg):
+        bits, target, cache, outputs, fn = arg
+        return self._embed((bitsToBil(bits, target, cache), outputs, fn))
+
+    def map(self, bils, outputs=None, fn=toSmt2, chunkSize=16):
+        """ Iterator over fn(assertions) of every BIL in bils, in order. An
+            exception raised for one of them is re-raised when its result
+            is reached.
+        """
+        return self.mPool.imap(self._embed,
+                               ((bil, outputs, fn) for bil in bils),
+                               chunkSize)
+
+    def mapBits(self, bitsIter, target='x86-64', cache=None, outputs=None,
+                fn=toSmt2, chunkSize=16):
+        """ map, lifting each of bitsIter on the workers first. cache (a
+            LiftCache) is shared by the workers - its entries are renamed
+            into place, so concurrent puts are safe, though its hit/miss
+            counts are only approximate.
+        """
+        return self.mPool.imap(self._liftAndEmbed,
+                               ((bits, target, cache, outputs, fn)
+                                for bits in bitsIter),
+                               chunkSize)
+
+    def submit(self, fn, *args):
+        """ Run fn(*args) on a worker, where it can embed through
+            contextPool(). Returns the pool's AsyncResult.
+        """
+        return self.mPool.apply_async(fn, args)
+
+    def close(self):
+        self.mPool.close()
+        self.mPool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,118 @@
+from collections import OrderedDict
+from z3 import Const, Goal, Tactic, Then, simplify, substitute, eq
+from .embedder import z3Ids, visitBil, visitBlock
+
+
+def transferFunction(embedder, names=None, simplifier=simplify):
+    """ Post-embedding cleanup of an already visited embedder. Turns the raw
+        SSA assertions of extract(names) into a compact transfer function:
+
+          - SSA temporaries used by a single definition (and trivial copies
+            such as RAX.0 == RAX.initial) are inlined into their user
+          - outputs that end up equal to their .initial value are dropped
+          - every remaining expression is run through simplifier
+
+        Returns (outputs, aux). outputs is a list of (name, expr) giving the
+        final value of each changed output in terms of .initial constants
+        (and any shared temporaries). aux lists the assertions defining the
+        temporaries that are used more than once and so were not inlined.
+    """
+    if names is None:
+        names = [name for (name, _) in embedder.arch_state()]
+
+    defs = OrderedDict()
+    for a in embedder.extract(names):
+        lhs, rhs = a.children()
+        defs[lhs.decl().name()] = rhs
+
+    # SSA names of the final values of changed outputs
+    finalNames = set()
+    for name in names:
+        node = embedder.mScope.lookupDef(name)
+        if node is not embedder.mRoot:
+            finalNames.add(node.ssa(name))
+
+    uses = {}
+    for rhs in defs.itervalues():
+        for (id, _) in z3Ids(rhs):
+            uses[id] = uses.get(id, 0) + 1
+
+    def inlinable(ssaName, rhs):
+        if ssaName in finalNames:
+            return False
+        return uses.get(ssaName, 0) <= 1 or len(rhs.children()) == 0
+
+    # defs are in dependency order, so everything a definition refers to has
+    # already been processed by the time we get to it.
+    inlined = {}
+    kept = OrderedDict()
+    for (ssaName, rhs) in defs.iteritems():
+        subst = [(Const(id, sort), inlined[id])
+                 for (id, sort) in z3Ids(rhs) if id in inlined]
+        if len(subst) > 0:
+            rhs = substitute(rhs, *subst)
+
+        if inlinable(ssaName, rhs):
+            inlined[ssaName] = rhs
+        else:
+            kept[ssaName] = rhs
+
+    outputs = []
+    for name in names:
+        ssaName, sort = embedder.lookup(name)
+        if ssaName not in finalNames:
+            continue  # Never changed
+
+        expr = simplifier(kept[ssaName])
+        if not eq(expr, Const(name + ".initial", sort)):  # Identity update
+            outputs.append((name, expr))
+
+    # Outputs are only needed as definitions if something else refers to
+    # their final SSA value (e.g. a load from the final mem64)
+    aux = [Const(auxName, auxRhs.sort()) == simplifier(auxRhs)
+           for (auxName, auxRhs) in kept.iteritems()
+           if auxName not in finalNames or uses.get(auxName, 0) > 0]
+    return (outputs, aux)
+
+
+def applyTactic(outputs, aux, tactic):
+    """ Run a tactic (a z3 Tactic, a tactic name or a list of tactic names
+        to chain) over a transfer function. Outputs are asserted as
+        NAME.final == expr. Returns the list of resulting assertions.
+    """
+    if len(outputs) == 0 and len(aux) == 0:
+        return []
+
+    ctx = (outputs[0][1] if len(outputs) > 0 else aux[0]).ctx
+    if isinstance(tactic, basestring):
+        tactic = [tactic]
+    if not isinstance(tactic, Tactic):
+        tactic = Tactic(tactic[0], ctx) if len(tactic) == 1 else \
+            Then(*tactic, ctx=ctx)
+
+    g = Goal(ctx=ctx)
+    for (name, expr) in outputs:
+        g.add(Const(name + ".final", expr.sort()) == expr)
+    for a in aux:
+        g.add(a)
+
+    res = []
+    for subgoal in tactic(g):
+        res.extend(subgoal[i] for i in range(len(subgoal)))
+    return res
+
+
+def transfer(bil, visitor_class, ctx=None, outputs=None,
+             simplifier=simplify):
+    """ Embed bil and return its simplified transfer function """
+    with visitBil(bil, visitor_class, ctx) as visitor:
+        return transferFunction(visitor, outputs, simplifier)
+
+
+def transferBlock(bils, visitor_class, ctx=None, outputs=None,
+                  simplifier=simplify):
+    """ Embed a sequence of instructions and return the simplified transfer
+        function of the whole sequence
+    """
+    with visitBlock(bils, visitor_class, ctx) as visitor:
+        return transferFunction(visitor, outputs, simplifier)
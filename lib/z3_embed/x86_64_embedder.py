@@ -1,14 +1,16 @@
 from bap.bil import Exp
 from z3 import BitVecSort, ArraySort
 from .base_embedder import BaseEmbedder
-from .embedder import embed
+from .raw_embedder import RawTermsEmbedder
+from .embedder import embed, embedBlock
+from .transfer import transfer, transferBlock
 
 
 class X86_64Z3Embedder(BaseEmbedder):
     """ X86_64 + AVX Embedder
     """
-    def arch_state(self):
-        ctx = self.mCtx
+    @classmethod
+    def archState(cls, ctx):
         return [("mem64", ArraySort(BitVecSort(64, ctx=ctx),
                                     BitVecSort(8, ctx=ctx))),
                 ("CF", BitVecSort(1, ctx=ctx)),
@@ -64,5 +66,47 @@ class X86_64Z3Embedder(BaseEmbedder):
         # Doesn't return a value
 
 
-def embed_x86(bil):
-    return embed(bil, X86_64Z3Embedder)
+class LazyX86_64Z3Embedder(X86_64Z3Embedder):
+    """ X86_64Z3Embedder with the lazy memory model (see BaseEmbedder)
+    """
+    lazyMemory = True
+
+
+class RawX86_64Z3Embedder(RawTermsEmbedder, X86_64Z3Embedder):
+    """ X86_64Z3Embedder building its terms through the z3 C API (see
+        RawTermsEmbedder)
+    """
+    pass
+
+
+class RawLazyX86_64Z3Embedder(RawTermsEmbedder, LazyX86_64Z3Embedder):
+    """ LazyX86_64Z3Embedder building its terms through the z3 C API
+    """
+    pass
+
+
+def x86Class(lazyMemory, rawTerms=False):
+    if rawTerms:
+        return RawLazyX86_64Z3Embedder if lazyMemory else RawX86_64Z3Embedder
+    return LazyX86_64Z3Embedder if lazyMemory else X86_64Z3Embedder
+
+
+def embed_x86(bil, ctx=None, outputs=None, lazyMemory=False,
+              rawTerms=False):
+    return embed(bil, x86Class(lazyMemory, rawTerms), ctx, outputs)
+
+
+def transfer_x86(bil, ctx=None, outputs=None, lazyMemory=False,
+                 rawTerms=False):
+    return transfer(bil, x86Class(lazyMemory, rawTerms), ctx, outputs)
+
+
+def embed_x86_block(bils, ctx=None, outputs=None, lazyMemory=False,
+                    rawTerms=False):
+    return embedBlock(bils, x86Class(lazyMemory, rawTerms), ctx, outputs)
+
+
+def transfer_x86_block(bils, ctx=None, outputs=None, lazyMemory=False,
+                       rawTerms=False):
+    return transferBlock(bils, x86Class(lazyMemory, rawTerms), ctx,
+                         outputs)
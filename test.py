@@ -1,10 +1,15 @@
-from lib.util import Bits, toLLVMAsm
-from lib.z3_embed import bitsToBil, embed
-from traceback import print_exc
-from sys import exit
-from lib.z3_embed.embedder import StmtNode
+from bap.bil import Special, Move, Var, Imm, Int, LOW, EQ, PLUS, LT, If, \
+    Jmp, Unknown
+from z3 import Context, Solver, sat
+from lib.util import Bits, toAsm
+from lib.z3_embed import bitsToBil, embed_x86, embed_x86_block, \
+    X86_64Z3Embedder, ContextPool, FormulaStore
+from lib.z3_embed.embedder import embed
+from lib.z3_embed.profile import Profiler
+from shutil import rmtree
+from tempfile import mkdtemp
+import os
 
-unused = [print_exc]
 
 def filterUnchanged(asserts):
     def filterF(x):
@@ -21,6 +26,71 @@ def filterUnchanged(asserts):
     return filter(filterF, asserts)
 
 
+def raisesNeverSeen(visitor_class):
+    try:
+        embed([Special("foo")], visitor_class, Context())
+    except Exception, e:
+        return str(e).startswith("Never seen")
+    return False
+
+
+# Unhandled constructors must raise, profiled or not
+assert raisesNeverSeen(X86_64Z3Embedder)
+assert raisesNeverSeen(Profiler().embedderClass(X86_64Z3Embedder))
+
+
+def R(name, width):
+    return Var(name, Imm(width))
+
+
+# Temporaries don't carry over between the instructions of a block, even
+# when the next one reuses a name at another width (test eax, eax; add
+# rax, rbx)
+testEax = [Move(R("v1", 32), LOW(32, R("RAX", 64))),
+           Move(R("ZF", 1), EQ(R("v1", 32), Int(0, 32)))]
+addRaxRbx = [Move(R("v1", 64), R("RAX", 64)),
+             Move(R("RAX", 64), PLUS(R("RAX", 64), R("RBX", 64))),
+             Move(R("CF", 1), LT(R("RAX", 64), R("v1", 64)))]
+assert len(embed_x86_block([testEax, addRaxRbx],
+                           outputs=["RAX", "CF", "ZF"])) > 0
+
+# Every statement of a tuple If branch is embedded
+jzSetRax = [If(R("ZF", 1), (Move(R("RAX", 64), Int(1, 64)),
+                            Jmp(PLUS(R("RIP", 64), Int(0x10, 64)))), ())]
+assert len(embed_x86(jzSetRax, outputs=["RAX"])) > 0
+
+# Embeddings sharing a pooled context don't reuse each other's SSA names
+pool = ContextPool()
+raxIs1 = pool.embed([Move(R("RAX", 64), Int(1, 64))], X86_64Z3Embedder)
+raxIs2 = pool.embed([Move(R("RAX", 64), Int(2, 64))], X86_64Z3Embedder)
+assert raxIs1[0].ctx is raxIs2[0].ctx
+s = Solver(ctx=raxIs1[0].ctx)
+s.add(*(raxIs1 + raxIs2))
+assert s.check() == sat
+
+# ... nor each other's unknowns
+raxUnk = pool.embed([Move(R("RAX", 64), Unknown("bits", Imm(64)))],
+                    X86_64Z3Embedder, outputs=["RAX"])
+rbxUnk = pool.embed([Move(R("RBX", 64), Unknown("bits", Imm(64)))],
+                    X86_64Z3Embedder, outputs=["RBX"])
+s = Solver(ctx=raxUnk[0].ctx)
+s.add(*(raxUnk + rbxUnk))
+s.add(raxUnk[-1].arg(0) != rbxUnk[-1].arg(0))
+assert s.check() == sat
+
+# A put after a torn index line (e.g. a killed writer) survives a reopen
+storeDir = mkdtemp()
+storePath = os.path.join(storeDir, "formulas")
+with FormulaStore(storePath) as store:
+    store.putSmt2("\x90", "(assert true)\n")
+with open(storePath + ".idx", "a") as f:
+    f.write("c375cc 150 7")
+with FormulaStore(storePath) as store:
+    store.putSmt2("\xc3", "(assert false)\n")
+assert FormulaStore(storePath).getSmt2("\xc3") == "(assert false)\n"
+rmtree(storeDir)
+
+
 pat1 = Bits("ff 25 02 37 cb 03")
 pat2 = Bits("0f 84 c1 00 00 00")
 pat3 = Bits("49 89 f5")
@@ -29,53 +99,14 @@ divq = Bits("48 f7 f1")
 add = Bits("48 83 c4 08")
 
 bil = bitsToBil(add)
-print "==============ASM : ", toLLVMAsm(add)
+print "==============ASM : ", toAsm(add)
 print "==============BIT Pattern: ", add.toHexStr()
 print "===============BIL:\n", "\n".join(map(str, bil))
 
 print "==============Z3 Formulas: \n"
-z3Vis = embed(bil)
-print "\n".join(map(str, filterUnchanged(z3Vis.extract())))
-
-exit()
-
-"""
-readC = 0
-startSkipC = 8931
-skipC = startSkipC
-failedParsing = []
-failedEmbedding = []
-
-with open('../libxul.hex') as f:
-    for l in f:
-        if skipC > 0:
-            skipC -= 1
-            continue
-
-        readC += 1
-        z3Vis = None
-
-        b = Bits(l.strip())
-        try:
-            bil = bitsToBil(b)
-        except Exception:
-            print "Failed parsing ", l
-            print_exc()
-            failedParsing.append(l)
-            continue
-        try:
-            StmtNode.sId = 0  # 0-out ctr for easy reading
-            z3Vis = embed(bil)
-        except AssertionError, e:
-            print e.message
-            print l.strip()
-            print toLLVMAsm(b)
-            # print "\n".join(map(str, bil))
-            print "New skipC: ", startSkipC + readC - 1
-            failedParsing.append((l, bil, e))
-
-        if (z3Vis):
-            print l
-            print bil
-            print z3Vis.extract()
-"""
+print "\n".join(map(str, filterUnchanged(embed_x86(bil))))
+
+print "==============Z3 Formulas (RSP, CF only): \n"
+print "\n".join(map(str, embed_x86(bil, outputs=["RSP", "CF"])))
+
+# To embed a whole corpus (e.g. libxul.hex) see lib/corpus.py